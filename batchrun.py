@@ -0,0 +1,608 @@
+ # -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Command line runner for the geomcore engines, no QGIS needed. Reads GeoPackage or CSV (WKT or x / y
+columns) inputs and streams the results to GeoPackage, CSV or Parquet, one output file per input file.
+
+    python batchrun.py events ALIGNMENT EVENTS... -o OUTPUT_DIR [--route-field F] [--epsilon E]
+    python batchrun.py near NEAR INPUTS... -o OUTPUT_DIR --input-field F --near-field F [--k-nearest K] [--matrix]
+
+EVENTS and INPUTS may be files or folders of .gpkg / .csv files. The alignment or near layer is
+loaded once per invocation however many inputs follow. The near runner measures point layers only.
+"""
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import time
+import struct
+import sqlite3
+import argparse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+# Geometry core shared with the klaw-processing scripts, it sits next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from geomcore import (alignment_key,
+                      build_alignment,
+                      cached_alignment,
+                      consolidate_record,
+                      distance_fancy_str,
+                      nearest_points,
+                      BLOCK_CELLS,
+                      CHUNK_EVENTS,
+                      WRITE_BATCH,
+                      NearMatrixWriter,
+                      ordered_map,
+                      project_events,
+                      np)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Rows per GeoPackage transaction
+COMMIT_ROWS = 200000
+
+OUTPUT_FORMATS = {"gpkg": ".gpkg", "csv": ".csv", "parquet": ".parquet"}
+
+def wkb_parts(blob, offset = 0):
+    """
+    Vertex lists [(xs, ys), ...] of a WKB geometry, one per point, line or ring, plus the offset just past
+    it. ISO and EWKB Z / M ordinates are read past and dropped.
+    """
+    order = "<" if blob[offset] == 1 else ">"
+    geometry_type = struct.unpack_from(order + "I", blob, offset + 1)[0]
+    offset += 5
+    
+    dims = 2 + bool(geometry_type & 0x80000000) + bool(geometry_type & 0x40000000)
+    if geometry_type & 0x20000000:
+        offset += 4
+    geometry_type &= 0x0FFFFFFF
+    if geometry_type > 1000:
+        dims += 2 if geometry_type // 1000 == 3 else 1
+        geometry_type %= 1000
+
+    def points(count, offset):
+        values = struct.unpack_from("{0}{1}d".format(order, count * dims), blob, offset)
+        return (list(values[0::dims]), list(values[1::dims])), offset + 8 * count * dims
+    
+    if geometry_type == 1:
+        part, offset = points(1, offset)
+        return ([part] if part[0][0] == part[0][0] else []), offset
+    
+    if geometry_type == 2:
+        count = struct.unpack_from(order + "I", blob, offset)[0]
+        part, offset = points(count, offset + 4)
+        return [part], offset
+    
+    if geometry_type == 3:
+        parts = []
+        rings = struct.unpack_from(order + "I", blob, offset)[0]
+        offset += 4
+        for _ in range(rings):
+            count = struct.unpack_from(order + "I", blob, offset)[0]
+            part, offset = points(count, offset + 4)
+            parts.append(part)
+            continue
+        return parts, offset
+    
+    if geometry_type in (4, 5, 6, 7):
+        parts = []
+        members = struct.unpack_from(order + "I", blob, offset)[0]
+        offset += 4
+        for _ in range(members):
+            member_parts, offset = wkb_parts(blob, offset)
+            parts.extend(member_parts)
+            continue
+        return parts, offset
+    
+    raise ValueError("Unsupported WKB geometry type {0}".format(geometry_type))
+
+def wkt_parts(text):
+    """
+    Vertex lists of a WKT geometry, one per innermost parenthesised run of coordinates.
+    """
+    parts = []
+    for run in re.findall(r"\(([^()]*)\)", text or ""):
+        xs = []
+        ys = []
+        for vertex in run.split(","):
+            values = vertex.split()
+            if len(values) >= 2:
+                xs.append(float(values[0]))
+                ys.append(float(values[1]))
+            continue
+        if xs:
+            parts.append((xs, ys))
+        continue
+    return parts
+
+def geometry_wkb(kind, xs, ys):
+    """
+    Little endian 2D WKB of a MultiPoint or LineString.
+    """
+    if kind == "MultiPoint":
+        return struct.pack("<BII", 1, 4, len(xs)) + b"".join(struct.pack("<BIdd", 1, 1, x, y) for x, y in zip(xs, ys))
+    return struct.pack("<BII", 1, 2, len(xs)) + struct.pack("<{0}d".format(2 * len(xs)), *[v for xy in zip(xs, ys) for v in xy])
+
+def geometry_wkt(kind, xs, ys):
+    """
+    WKT of a MultiPoint or LineString. Coordinates go through float() so NumPy scalars print as numbers.
+    """
+    if kind == "MultiPoint":
+        return "MultiPoint ({0})".format(", ".join("({0!r} {1!r})".format(float(x), float(y)) for x, y in zip(xs, ys)))
+    return "LineString ({0})".format(", ".join("{0!r} {1!r}".format(float(x), float(y)) for x, y in zip(xs, ys)))
+
+def read_features(path, layer = None):
+    """
+    Opens a GeoPackage layer (the first one unless layer is given) or a CSV file. Returns (srs, rows) where
+    srs is the source gpkg_spatial_ref_sys row or None and rows yields (attributes dict, vertex lists).
+    CSV geometry comes from a wkt / geometry column, else from x and y columns.
+    """
+    if path.lower().endswith(".gpkg"):
+        connection = sqlite3.connect("file:{0}?mode=ro".format(path), uri = True)
+        query = "SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns"
+        found = connection.execute(query + " WHERE table_name = ?", (layer,)).fetchone() if layer else connection.execute(query).fetchone()
+        if found is None:
+            raise SystemExit("{0}: no geometry layer {1}".format(path, layer or ""))
+        
+        table, column, srs_id = found
+        srs = connection.execute("SELECT * FROM gpkg_spatial_ref_sys WHERE srs_id = ?", (srs_id,)).fetchone()
+
+        def gpkg_rows():
+            cursor = connection.execute('SELECT * FROM "{0}"'.format(table.replace('"', '""')))
+            names = [i[0] for i in cursor.description]
+            geometry_idx = names.index(column)
+            for values in cursor:
+                blob = values[geometry_idx]
+                parts = []
+                if blob is not None:
+                    # GeoPackage header: magic, version, flags, srs id, then an envelope sized by the flags
+                    envelope = (0, 32, 48, 48, 64)[(blob[3] >> 1) & 7]
+                    parts = wkb_parts(blob, 8 + envelope)[0]
+                yield dict(zip(names, values)), parts
+                continue
+            connection.close()
+        
+        return srs, gpkg_rows()
+
+    def csv_rows():
+        with open(path, newline = "") as handle:
+            for attributes in csv.DictReader(handle):
+                text = attributes.get("wkt") or attributes.get("WKT") or attributes.get("geometry")
+                if text is not None:
+                    parts = wkt_parts(text)
+                elif attributes.get("x") not in (None, "") and attributes.get("y") not in (None, ""):
+                    parts = [([float(attributes["x"])], [float(attributes["y"])])]
+                else:
+                    parts = []
+                yield attributes, parts
+                continue
+    
+    return None, csv_rows()
+
+def input_paths(paths):
+    """
+    Files of paths, folders expanded to their .gpkg and .csv files in name order. Outputs are named after
+    the input without its extension, so two inputs of the same name (x.gpkg and x.csv) stop the run.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, "*.gpkg")) + glob.glob(os.path.join(path, "*.csv"))))
+        else:
+            found.append(path)
+        continue
+    
+    names = {}
+    for path in found:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            raise SystemExit("{0} and {1} would both write the output {2}, rename one of them".format(names[name], path, name))
+        names[name] = path
+        continue
+    return found
+
+
+class CsvWriter:
+    """
+    Streams rows to CSV, geometry as a trailing wkt column.
+    """
+
+    def __init__(self, path, fields, geometry_kind, srs):
+        self.handle = open(path, "w", newline = "")
+        self.writer = csv.writer(self.handle)
+        self.geometry_kind = geometry_kind
+        self.writer.writerow([i[0] for i in fields] + (["wkt"] if geometry_kind else []))
+
+    def write(self, rows):
+        if self.geometry_kind:
+            rows = (row[:-1] + [geometry_wkt(self.geometry_kind, *row[-1])] for row in rows)
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.handle.close()
+
+
+class GpkgWriter:
+    """
+    Streams rows into a new GeoPackage table named after the file. Rows are inserted a batch at a time
+    with executemany and committed every COMMIT_ROWS, so the journal is written once per transaction
+    instead of once per feature. An integer field named fid becomes the table's primary key.
+    """
+    
+    TYPES = {"int": "INTEGER", "float": "DOUBLE", "text": "TEXT"}
+
+    def __init__(self, path, fields, geometry_kind, srs):
+        if os.path.exists(path):
+            os.remove(path)
+        
+        self.connection = sqlite3.connect(path, isolation_level = None)
+        self.geometry_kind = geometry_kind
+        self.srs_id = srs[1] if srs is not None else -1
+        self.pending = 0
+        self.bounds = None
+        self.table = os.path.splitext(os.path.basename(path))[0]
+        self.has_fid = bool(fields) and fields[0] == ("fid", "int")
+        
+        connection = self.connection
+        connection.execute("PRAGMA application_id = 1196444487")
+        connection.execute("PRAGMA user_version = 10200")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)")
+        connection.execute("CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)")
+        connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, PRIMARY KEY (table_name, column_name))")
+        connection.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ("WGS 84 geodetic", 4326, "EPSG", 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', None)
+        ])
+        if srs is not None and srs[1] not in (-1, 0, 4326):
+            connection.execute("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", tuple(srs[:6]))
+        
+        columns = ["fid INTEGER PRIMARY KEY AUTOINCREMENT"]
+        if geometry_kind:
+            columns.append("geom {0}".format(geometry_kind.upper()))
+        columns += ['"{0}" {1}'.format(name, self.TYPES[kind]) for name, kind in fields[1 if self.has_fid else 0:]]
+        connection.execute('CREATE TABLE "{0}" ({1})'.format(self.table, ", ".join(columns)))
+        
+        names = (["fid"] if self.has_fid else []) + (["geom"] if geometry_kind else []) + ['"{0}"'.format(i[0]) for i in fields[1 if self.has_fid else 0:]]
+        self.insert = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(self.table, ", ".join(names), ", ".join("?" * len(names)))
+        self.header = b"GP\x00\x01" + struct.pack("<i", self.srs_id)
+        connection.execute("BEGIN")
+
+    def write(self, rows):
+        values = []
+        for row in rows:
+            attributes = row
+            if self.geometry_kind:
+                attributes = row[:-1]
+                xs, ys = row[-1]
+                geometry = self.header + geometry_wkb(self.geometry_kind, xs, ys)
+                box = (min(xs), min(ys), max(xs), max(ys))
+                self.bounds = box if self.bounds is None else (min(self.bounds[0], box[0]), min(self.bounds[1], box[1]), max(self.bounds[2], box[2]), max(self.bounds[3], box[3]))
+                attributes = (attributes[:1] + [geometry] + attributes[1:]) if self.has_fid else [geometry] + attributes
+            values.append(attributes)
+            continue
+        
+        self.connection.executemany(self.insert, values)
+        self.pending += len(values)
+        if self.pending >= COMMIT_ROWS:
+            self.connection.execute("COMMIT")
+            self.connection.execute("BEGIN")
+            self.pending = 0
+
+    def close(self):
+        connection = self.connection
+        bounds = self.bounds or (None, None, None, None)
+        connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (self.table, "features" if self.geometry_kind else "attributes", self.table) + tuple(bounds) + (self.srs_id,))
+        if self.geometry_kind:
+            connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)", (self.table, self.geometry_kind.upper(), self.srs_id))
+        connection.execute("COMMIT")
+        connection.close()
+
+
+class ParquetWriter:
+    """
+    Streams rows to Parquet with pyarrow, one row group per batch, geometry as a WKB column with GeoParquet
+    metadata.
+    """
+    
+    TYPES = {"int": "int64", "float": "float64", "text": "string"}
+
+    def __init__(self, path, fields, geometry_kind, srs):
+        if pyarrow is None:
+            raise SystemExit("Parquet output needs pyarrow")
+        
+        self.fields = fields
+        self.geometry_kind = geometry_kind
+        schema = [pyarrow.field(name, getattr(pyarrow, self.TYPES[kind])()) for name, kind in fields]
+        metadata = None
+        if geometry_kind:
+            schema.append(pyarrow.field("geometry", pyarrow.binary()))
+            metadata = {"geo": json.dumps({"version": "1.0.0", "primary_column": "geometry", "columns": {"geometry": {"encoding": "WKB", "geometry_types": [geometry_kind]}}})}
+        self.schema = pyarrow.schema(schema, metadata = metadata)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in self.schema]
+        if self.geometry_kind and rows:
+            columns[-1] = [geometry_wkb(self.geometry_kind, *i) for i in columns[-1]]
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(list(i), type = j.type) for i, j in zip(columns, self.schema)], schema = self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"gpkg": GpkgWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+def write_rows(writer, rows):
+    """
+    Hands rows to writer WRITE_BATCH at a time. Returns the row count.
+    """
+    count = 0
+    for start in range(0, len(rows), WRITE_BATCH):
+        batch = rows[start:start + WRITE_BATCH]
+        writer.write(batch)
+        count += len(batch)
+        continue
+    return count
+
+def load_alignment_routes(path, layer, route_field):
+    """
+    (srs, routes) of an alignment file, routes as (route_id, xs, ys). Multipart lines are refused.
+    """
+    srs, rows = read_features(path, layer)
+    routes = []
+    for attributes, parts in rows:
+        if not parts:
+            continue
+        if len(parts) > 1:
+            raise SystemExit("Alignment has multipart geometry. Convert LAYER to single parts.")
+        
+        routes.append((attributes.get(route_field) if route_field else None, parts[0][0], parts[0][1]))
+        continue
+    
+    if len(routes) != 1 and not route_field:
+        raise SystemExit("Alignment has more than one feature. Only one singlepart feature is allowed unless a route field is set.")
+    return srs, routes
+
+def event_fields(with_route):
+    """
+    Output fields of the events runner, those of the Processing algorithm.
+    """
+    fields = [("fid", "int"), ("event_id", "text"), ("event_layer", "text"), ("event_comment", "text"), ("distance_away", "float"), ("distance_line", "float"),
+              ("distance_line_str", "text"), ("side_of_line", "text"), ("line_x", "float"), ("line_y", "float"), ("event_type", "text")]
+    if with_route:
+        fields.append(("route_id", "text"))
+    return fields
+
+def event_records(event_name, event_xs, event_ys, event_ids, event_comments, projected, route_ids, segment_index, with_route, consolidate):
+    """
+    Yields the output rows of one event layer a block at a time from (chunk_start, projections) pairs in
+    chunk order, geometry last as (xs, ys). Rows that are not consolidated come out with their chunk, only
+    the consolidation groups are held back and their Start / End survivors come last in fid order, as in
+    the Processing algorithm.
+    """
+    sides = {-1: "Left", 1: "Right"}
+    consolidated = {}
+    output_fid = 1
+    
+    for chunk_start, projections in projected:
+        rows = []
+        for event_idx, projection in enumerate(projections, chunk_start):
+            if projection is None:
+                continue
+            
+            distance_away, distance_on_line, line_x, line_y, side_of_line, vertex_idx_after = projection
+            eid = str(event_ids[event_idx])
+            route_id = route_ids[segment_index.route_of(vertex_idx_after)]
+            row = [output_fid, eid, event_name, event_comments[event_idx], distance_away, distance_on_line, distance_fancy_str(distance_on_line, None),
+                   sides.get(side_of_line, "Unknown / On Line"), line_x, line_y, "Unitary"]
+            if with_route:
+                row.append(str(route_id))
+            row.append(([event_xs[event_idx], line_x], [event_ys[event_idx], line_y]))
+            
+            if consolidate and eid != "-":
+                consolidate_record(consolidated, (route_id, eid), row, distance_on_line)
+            else:
+                rows.append(row)
+            output_fid += 1
+            continue
+        
+        yield rows
+        continue
+    
+    survivors = []
+    for count, min_row, min_distance, max_row, max_distance in consolidated.values():
+        survivors.append(min_row)
+        if count > 1:
+            min_row[10] = "Start"
+            max_row[10] = "End"
+            survivors.append(max_row)
+        continue
+    
+    survivors.sort(key = lambda i: i[0])
+    yield survivors
+
+def run_events(args):
+    srs, routes = load_alignment_routes(args.alignment, args.alignment_layer, args.route_field)
+    key = alignment_key(repr(srs), args.route_field or "", [(i[0], array("d", i[1] + i[2]).tobytes()) for i in routes])
+    entry, origin = cached_alignment(key, lambda: build_alignment(routes), args.cache_dir or "")
+    if entry is None:
+        raise SystemExit("Alignment has no line with at least two vertices.")
+    
+    route_ids, chainages, segment_index = entry
+    print("Alignment preprocessing: {0}".format(origin), file = sys.stderr)
+    fields = event_fields(args.route_field)
+    
+    workers = args.workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for path in input_paths(args.events):
+            started = time.perf_counter()
+            event_name = os.path.splitext(os.path.basename(path))[0]
+            
+            event_xs = array("d")
+            event_ys = array("d")
+            event_ids = []
+            event_comments = []
+            for attributes, parts in read_features(path, args.events_layer)[1]:
+                eid = attributes.get("GUID", "-")
+                comment = attributes.get("comment", "")
+                for xs, ys in parts:
+                    event_xs.extend(xs)
+                    event_ys.extend(ys)
+                    event_ids.extend([eid] * len(xs))
+                    event_comments.extend([comment] * len(xs))
+                    continue
+                continue
+            
+            def project_chunk(chunk_start):
+                chunk_end = chunk_start + CHUNK_EVENTS
+                return project_events(segment_index, chainages, event_xs[chunk_start:chunk_end], event_ys[chunk_start:chunk_end], args.epsilon)
+            
+            # Rows reach the writer chunk by chunk as the pool projects them
+            projected = ordered_map(executor, project_chunk, range(0, len(event_xs), CHUNK_EVENTS), workers * 2)
+            writer = WRITERS[args.format](os.path.join(args.output_dir, event_name + OUTPUT_FORMATS[args.format]), fields, "MultiPoint", srs)
+            count = 0
+            for rows in event_records(event_name, event_xs, event_ys, event_ids, event_comments, projected, route_ids, segment_index, args.route_field, not args.no_consolidate):
+                count += write_rows(writer, rows)
+                continue
+            writer.close()
+            print("{0}: {1} events, {2} records, {3:.2f}s".format(path, len(event_xs), count, time.perf_counter() - started), file = sys.stderr)
+            continue
+
+def point_xy(path, parts):
+    """
+    (x, y) of a single point geometry. The near runner measures points only, anything else would be
+    measured from one of its vertices, so it stops the run.
+    """
+    if len(parts) != 1 or len(parts[0][0]) != 1:
+        raise SystemExit("{0}: the near runner takes point layers only, found a geometry of {1} vertices".format(path, sum(len(i[0]) for i in parts)))
+    return parts[0][0][0], parts[0][1][0]
+
+def run_near(args):
+    if np is None:
+        raise SystemExit("The near runner needs NumPy")
+    
+    srs, rows = read_features(args.near, args.near_layer)
+    near_ids = []
+    near_xy = []
+    for attributes, parts in rows:
+        if parts:
+            near_ids.append(attributes.get(args.near_field))
+            near_xy.append(point_xy(args.near, parts))
+        continue
+    near_xy = np.array(near_xy, dtype = float).reshape(-1, 2)
+    
+    near_name = args.near_field if args.near_field != args.input_field else args.near_field + "_"
+    fields = [(args.input_field, "text"), (near_name, "text"), ("distance", "float")]
+    geometry_kind = "LineString" if args.lines else None
+    block_rows = max(1, BLOCK_CELLS // max(len(near_ids), 1))
+    
+    for path in input_paths(args.inputs):
+        started = time.perf_counter()
+        name = os.path.splitext(os.path.basename(path))[0]
+        if args.matrix:
+            writer = NearMatrixWriter(os.path.join(args.output_dir, name), near_ids, args.k_nearest == 0 and args.max_distance == -1, {"k_nearest": args.k_nearest, "max_distance": args.max_distance})
+        else:
+            writer = WRITERS[args.format](os.path.join(args.output_dir, name + OUTPUT_FORMATS[args.format]), fields, geometry_kind, srs)
+        
+        input_ids = []
+        input_xy = []
+        count = 0
+        for attributes, parts in read_features(path, args.input_layer)[1]:
+            if parts:
+                input_ids.append(attributes.get(args.input_field))
+                input_xy.append(point_xy(path, parts))
+            if len(input_ids) < block_rows:
+                continue
+            count += write_near_block(writer, input_ids, input_xy, near_ids, near_xy, args)
+            input_ids = []
+            input_xy = []
+            continue
+        
+        if input_ids:
+            count += write_near_block(writer, input_ids, input_xy, near_ids, near_xy, args)
+        writer.close()
+        print("{0}: {1} rows, {2:.2f}s".format(path, count, time.perf_counter() - started), file = sys.stderr)
+        continue
+
+def write_near_block(writer, input_ids, input_xy, near_ids, near_xy, args):
+    """
+    Distance block of one batch of input points, written as (input_id, near_id, distance[, line]) rows.
+    """
+    input_xy = np.array(input_xy, dtype = float)
+    input_idx, near_idx, distances = nearest_points(input_xy, near_xy, args.k_nearest, args.max_distance)
+    if args.matrix:
+        writer.add_rows(input_ids, input_idx, near_idx, distances)
+        return len(input_idx)
+    
+    # Line ends as Python floats, gathered for the kept pairs only
+    starts = input_xy[input_idx].tolist() if args.lines else None
+    ends = near_xy[near_idx].tolist() if args.lines else None
+    
+    rows = []
+    for pair, (i, j, distance) in enumerate(zip(input_idx.tolist(), near_idx.tolist(), distances.tolist())):
+        row = [str(input_ids[i]), str(near_ids[j]), distance]
+        if args.lines:
+            row.append(([starts[pair][0], ends[pair][0]], [starts[pair][1], ends[pair][1]]))
+        rows.append(row)
+        continue
+    
+    return write_rows(writer, rows)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Batch runner for the klaw-processing engines")
+    parser.add_argument("-o", "--output-dir", required = True)
+    parser.add_argument("-f", "--format", choices = sorted(OUTPUT_FORMATS), default = "gpkg")
+    parser.add_argument("-w", "--workers", type = int, default = 1, help = "worker threads, 0 for all cores")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    
+    events = commands.add_parser("events", help = "linear reference event points against an alignment")
+    events.add_argument("alignment")
+    events.add_argument("events", nargs = "+")
+    events.add_argument("--alignment-layer")
+    events.add_argument("--events-layer")
+    events.add_argument("--route-field")
+    events.add_argument("--epsilon", type = float, default = -1)
+    events.add_argument("--no-consolidate", action = "store_true")
+    events.add_argument("--cache-dir")
+    
+    near = commands.add_parser("near", help = "point distance matrix, point layers only")
+    near.add_argument("near")
+    near.add_argument("inputs", nargs = "+")
+    near.add_argument("--near-layer")
+    near.add_argument("--input-layer")
+    near.add_argument("--input-field", required = True)
+    near.add_argument("--near-field", required = True)
+    near.add_argument("--k-nearest", type = int, default = 0)
+    near.add_argument("--max-distance", type = float, default = -1)
+    near.add_argument("--lines", action = "store_true", help = "write the shortest line of every pair")
+    near.add_argument("--matrix", action = "store_true", help = "write a folder of NumPy arrays per input instead of a table")
+    
+    args = parser.parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok = True)
+    if args.command == "events":
+        run_events(args)
+    else:
+        run_near(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+ # -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Benchmarks of the linear reference events and near matrix engines on seeded synthetic data. Inputs are
+generated as GeoPackages in a scratch folder, then run through the same code as batchrun.py phase by
+phase: load, preprocess, project, consolidate and write for events, load, distance and write for the
+near matrix. Seconds, throughput and peak traced memory of every phase go to a JSON report.
+
+    python benchmarks/bench.py --preset small -o report.json
+    python benchmarks/bench.py --vertices 1000000 --events 10000000 --near-inputs 0 -o events.json
+
+Presets run from small (seconds) to large (10^6 vertices, 10^7 events, 10^5 x 10^5 near matrix).
+Memory tracing slows Python heavy phases down, --no-trace gives clean timings without the peaks.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import tracemalloc
+from array import array
+
+# Engines live one folder up, next to the Processing scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from geomcore import (build_alignment,
+                      project_events,
+                      nearest_points,
+                      BLOCK_CELLS,
+                      CHUNK_EVENTS,
+                      np)
+from batchrun import (WRITERS,
+                      OUTPUT_FORMATS,
+                      event_fields,
+                      event_records,
+                      load_alignment_routes,
+                      read_features,
+                      write_rows)
+
+
+# vertices, routes, events, near inputs, near points
+PRESETS = {
+    "small": (1000, 1, 100000, 1000, 1000),
+    "medium": (100000, 10, 1000000, 10000, 10000),
+    "large": (1000000, 100, 10000000, 100000, 100000),
+}
+
+# Mean vertex spacing and the spread of events either side of the alignment, metres
+VERTEX_STEP = 10.0
+EVENT_SPREAD = 25.0
+
+# Events sharing a GUID, before consolidation
+GROUP_SIZE = 4
+
+
+class Phases:
+    """
+    Times the phases of one benchmark. Each phase records its seconds, item count, items per second and,
+    when tracing, the peak of memory allocated during the phase.
+    """
+    
+    def __init__(self, trace):
+        self.trace = trace
+        self.results = {}
+    
+    def run(self, name, items, func, *args):
+        if self.trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        
+        started = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - started
+        
+        count = items(result) if callable(items) else items
+        record = {"seconds": seconds, "items": count, "items_per_second": count / seconds if seconds > 0 else None}
+        if self.trace:
+            record["peak_mb"] = (tracemalloc.get_traced_memory()[1] - before) / 2 ** 20
+        self.results[name] = record
+        print("  {0:<12} {1:>10} items {2:>9.3f}s".format(name, count, seconds), file = sys.stderr)
+        return result
+
+
+def synthetic_alignment(rng, vertices, routes):
+    """
+    Seeded random walk of vertices points with a slowly drifting heading, split into routes consecutive
+    routes. Returns (route_id, xs, ys) tuples.
+    """
+    headings = np.cumsum(rng.normal(0.0, 0.05, vertices))
+    steps = rng.uniform(0.5, 1.5, vertices) * VERTEX_STEP
+    xs = np.cumsum(steps * np.cos(headings))
+    ys = np.cumsum(steps * np.sin(headings))
+    
+    bounds = np.linspace(0, vertices, routes + 1).astype(int)
+    return [("R{0}".format(i), xs[start:end].tolist(), ys[start:end].tolist()) for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end - start > 1]
+
+def synthetic_events(rng, alignment, count):
+    """
+    Seeded event points scattered either side of random spots along the alignment. Returns (xs, ys, ids)
+    with ids shared along GROUP_SIZE segments and one in ten left as "-".
+    """
+    xs = np.concatenate([i[1] for i in alignment])
+    ys = np.concatenate([i[2] for i in alignment])
+    
+    segments = rng.integers(0, len(xs) - 1, count)
+    segments = segments[np.isin(segments + 1, np.cumsum([len(i[1]) for i in alignment]), invert = True)]
+    along = rng.uniform(0.0, 1.0, len(segments))
+    offsets = rng.normal(0.0, EVENT_SPREAD, len(segments))
+    
+    dx = xs[segments + 1] - xs[segments]
+    dy = ys[segments + 1] - ys[segments]
+    length = np.hypot(dx, dy)
+    event_xs = xs[segments] + along * dx - offsets * dy / length
+    event_ys = ys[segments] + along * dy + offsets * dx / length
+    
+    ids = ["-" if group % 10 == 0 else "G{0}".format(group) for group in (segments // GROUP_SIZE).tolist()]
+    return event_xs, event_ys, ids
+
+def write_points(path, name_field, names, xs, ys):
+    """
+    Point GeoPackage of names and coordinates, one single point MultiPoint per row.
+    """
+    writer = WRITERS["gpkg"](path, [(name_field, "text")], "MultiPoint", None)
+    write_rows(writer, [[name, ([x], [y])] for name, x, y in zip(names, xs.tolist(), ys.tolist())])
+    writer.close()
+
+def load_events(path):
+    """
+    Event coordinates, ids and comments of an event GeoPackage, as in batchrun.py.
+    """
+    event_xs = array("d")
+    event_ys = array("d")
+    event_ids = []
+    event_comments = []
+    for attributes, parts in read_features(path)[1]:
+        for xs, ys in parts:
+            event_xs.extend(xs)
+            event_ys.extend(ys)
+            event_ids.extend([attributes.get("GUID", "-")] * len(xs))
+            event_comments.extend([attributes.get("comment", "")] * len(xs))
+            continue
+        continue
+    return event_xs, event_ys, event_ids, event_comments
+
+def load_points(path, name_field):
+    """
+    (names, (n, 2) coordinates) of a point GeoPackage.
+    """
+    names = []
+    xy = []
+    for attributes, parts in read_features(path)[1]:
+        if parts:
+            names.append(attributes.get(name_field))
+            xy.append((parts[0][0][0], parts[0][1][0]))
+        continue
+    return names, np.array(xy, dtype = float).reshape(-1, 2)
+
+def bench_events(args, scratch, phases):
+    """
+    Linear reference events over a synthetic alignment, phase by phase.
+    """
+    rng = np.random.default_rng(args.seed)
+    alignment = synthetic_alignment(rng, args.vertices, args.routes)
+    event_xs, event_ys, event_ids = synthetic_events(rng, alignment, args.events)
+    
+    alignment_path = os.path.join(scratch, "alignment.gpkg")
+    writer = WRITERS["gpkg"](alignment_path, [("route_id", "text")], "LineString", None)
+    write_rows(writer, [[route_id, (xs, ys)] for route_id, xs, ys in alignment])
+    writer.close()
+    events_path = os.path.join(scratch, "events.gpkg")
+    write_points(events_path, "GUID", event_ids, event_xs, event_ys)
+    
+    def load():
+        return load_alignment_routes(alignment_path, None, "route_id")[1], load_events(events_path)
+    
+    routes, (event_xs, event_ys, event_ids, event_comments) = phases.run("load", len(event_xs) + args.vertices, load)
+    route_ids, chainages, segment_index = phases.run("preprocess", args.vertices, build_alignment, routes)
+    
+    def project():
+        projected = []
+        for chunk_start in range(0, len(event_xs), CHUNK_EVENTS):
+            chunk_end = chunk_start + CHUNK_EVENTS
+            projected.append((chunk_start, project_events(segment_index, chainages, event_xs[chunk_start:chunk_end], event_ys[chunk_start:chunk_end], -1)))
+            continue
+        return projected
+    
+    projected = phases.run("project", len(event_xs), project)
+    
+    def consolidate():
+        # batchrun streams these blocks into the writer, they are gathered here to time the phases apart
+        return [row for rows in event_records("events", event_xs, event_ys, event_ids, event_comments, projected, route_ids, segment_index, True, True) for row in rows]
+    
+    rows = phases.run("consolidate", len(event_xs), consolidate)
+    
+    def write():
+        writer = WRITERS[args.format](os.path.join(scratch, "events_out" + OUTPUT_FORMATS[args.format]), event_fields(True), "MultiPoint", None)
+        count = write_rows(writer, rows)
+        writer.close()
+        return count
+    
+    phases.run("write", len(rows), write)
+
+def bench_near(args, scratch, phases):
+    """
+    Near matrix of synthetic points, k nearest or all pairs, phase by phase.
+    """
+    rng = np.random.default_rng(args.seed + 1)
+    side = VERTEX_STEP * np.sqrt(max(args.near_inputs, args.near_points)) * 10
+    for name, count in (("inputs", args.near_inputs), ("near", args.near_points)):
+        xy = rng.uniform(0.0, side, (count, 2))
+        write_points(os.path.join(scratch, name + ".gpkg"), "name", ["{0}{1}".format(name[0], i) for i in range(count)], xy[:, 0], xy[:, 1])
+        continue
+    
+    def load():
+        return load_points(os.path.join(scratch, "inputs.gpkg"), "name"), load_points(os.path.join(scratch, "near.gpkg"), "name")
+    
+    (input_ids, input_xy), (near_ids, near_xy) = phases.run("load", args.near_inputs + args.near_points, load)
+    block_rows = max(1, BLOCK_CELLS // max(len(near_ids), 1))
+    
+    def distance():
+        blocks = []
+        for start in range(0, len(input_ids), block_rows):
+            input_idx, near_idx, distances = nearest_points(input_xy[start:start + block_rows], near_xy, args.k_nearest, -1)
+            if args.k_nearest > 0:
+                blocks.append((input_idx + start, near_idx, distances))
+            continue
+        return blocks
+    
+    # Full matrices are only computed, a 10^5 x 10^5 table does not fit any writer
+    blocks = phases.run("distance", len(input_ids) * len(near_ids), distance)
+    if args.k_nearest <= 0:
+        return
+    
+    def write():
+        writer = WRITERS[args.format](os.path.join(scratch, "near_out" + OUTPUT_FORMATS[args.format]), [("input", "text"), ("near", "text"), ("distance", "float")], None, None)
+        count = 0
+        for input_idx, near_idx, distances in blocks:
+            count += write_rows(writer, [[input_ids[i], near_ids[j], d] for i, j, d in zip(input_idx.tolist(), near_idx.tolist(), distances.tolist())])
+            continue
+        writer.close()
+        return count
+    
+    phases.run("write", lambda count: count, write)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks of the klaw-processing engines on synthetic data")
+    parser.add_argument("-o", "--output", help = "JSON report, printed when omitted")
+    parser.add_argument("-p", "--preset", choices = sorted(PRESETS), default = "small")
+    parser.add_argument("-s", "--seed", type = int, default = 0)
+    parser.add_argument("-f", "--format", choices = sorted(OUTPUT_FORMATS), default = "gpkg")
+    parser.add_argument("--vertices", type = int, help = "alignment vertices, 0 skips the events benchmark")
+    parser.add_argument("--routes", type = int)
+    parser.add_argument("--events", type = int)
+    parser.add_argument("--near-inputs", type = int, help = "near matrix rows, 0 skips the near benchmark")
+    parser.add_argument("--near-points", type = int)
+    parser.add_argument("--k-nearest", type = int, default = 1, help = "0 computes the full matrix without writing it")
+    parser.add_argument("--scratch", help = "folder for the generated inputs and outputs, a temporary one when omitted")
+    parser.add_argument("--no-trace", action = "store_true", help = "skip tracemalloc, timings without memory peaks")
+    args = parser.parse_args(argv)
+    
+    if np is None:
+        raise SystemExit("The benchmarks need NumPy")
+    
+    defaults = dict(zip(("vertices", "routes", "events", "near_inputs", "near_points"), PRESETS[args.preset]))
+    for name, value in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+        continue
+    
+    scratch = args.scratch or tempfile.mkdtemp(prefix = "klaw-bench-")
+    os.makedirs(scratch, exist_ok = True)
+    if not args.no_trace:
+        tracemalloc.start()
+    
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "settings": {i: getattr(args, i) for i in ("preset", "seed", "format", "vertices", "routes", "events", "near_inputs", "near_points", "k_nearest")},
+        "benchmarks": {},
+    }
+    
+    try:
+        for name, enabled, bench in (("events", args.vertices > 1 and args.events > 0, bench_events), ("near", args.near_inputs > 0 and args.near_points > 0, bench_near)):
+            if not enabled:
+                continue
+            
+            print(name, file = sys.stderr)
+            phases = Phases(not args.no_trace)
+            started = time.perf_counter()
+            bench(args, scratch, phases)
+            report["benchmarks"][name] = {"seconds": sum(i["seconds"] for i in phases.results.values()), "wall_seconds": time.perf_counter() - started, "phases": phases.results}
+            continue
+    finally:
+        if not args.scratch:
+            shutil.rmtree(scratch, ignore_errors = True)
+    
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["max_rss_mb"] = max_rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+    
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+ # -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+import os
+import sys
+from array import array
+from PyQt5.QtCore import QVariant
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsFeatureSink,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterField,
+                       QgsFields,
+                       QgsField,
+                       QgsWkbTypes,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsPoint)
+
+# Geometry core shared with the other klaw-processing scripts, it sits next to this file. Only helpers are
+# imported, an algorithm class in this namespace would be picked up by the script loader
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from geomcore import (alignment_key,
+                      build_alignment,
+                      cached_alignment,
+                      distance_fancy_str,
+                      parse_station,
+                      side_sign,
+                      station_points,
+                      station_points_scalar,
+                      np)
+from linearreferenceevents import route_coordinates
+
+
+# Table rows located per batch
+CHUNK_ROWS = 1 << 16
+
+
+class ChainagePointsAlgorithm(QgsProcessingAlgorithm):
+    """
+    Inverse of Linear Reference Events. Places the stations of a table along the alignment, with an
+    optional offset to either side.
+    """
+
+    INPUT = 'INPUT'
+    ROUTE_FIELD = 'ROUTE_FIELD'
+    TABLE = 'TABLE'
+    STATION_FIELD = 'STATION_FIELD'
+    OFFSET_FIELD = 'OFFSET_FIELD'
+    SIDE_FIELD = 'SIDE_FIELD'
+    TABLE_ROUTE_FIELD = 'TABLE_ROUTE_FIELD'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return ChainagePointsAlgorithm()
+
+    def name(self):
+        return 'chainagepoints'
+
+    def displayName(self):
+        return self.tr('Chainage Points')
+
+    def group(self):
+        return self.tr('klaw-processing')
+
+    def groupId(self):
+        return 'klaw-processing'
+
+    def shortHelpString(self):
+        return self.tr("Places stations such as 12+50, or plain measures, along the alignment. An offset moves "
+                       "the point square to the alignment, positive to the right and negative to the left unless "
+                       "a side field (Left / Right, as written by Linear Reference Events) gives the side.")
+
+    def initAlgorithm(self, config=None):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input Alignment'),
+                [QgsProcessing.TypeVectorLine]
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ROUTE_FIELD,
+                self.tr('Route ID Field'),
+                parentLayerParameterName = self.INPUT,
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.TABLE,
+                self.tr('Station Table'),
+                [QgsProcessing.TypeVector]
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.STATION_FIELD,
+                self.tr('Station Field'),
+                parentLayerParameterName = self.TABLE
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.OFFSET_FIELD,
+                self.tr('Offset Field'),
+                parentLayerParameterName = self.TABLE,
+                type = QgsProcessingParameterField.Numeric,
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.SIDE_FIELD,
+                self.tr('Side Field'),
+                parentLayerParameterName = self.TABLE,
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.TABLE_ROUTE_FIELD,
+                self.tr('Station Route ID Field'),
+                parentLayerParameterName = self.TABLE,
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('Output Points')
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Here is where the processing itself takes place.
+        """
+        alignment = self.parameterAsSource(
+            parameters,
+            self.INPUT,
+            context
+        )
+        
+        if alignment is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        
+        table = self.parameterAsSource(
+            parameters,
+            self.TABLE,
+            context
+        )
+        
+        if table is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.TABLE))
+        
+        route_field = self.parameterAsString(parameters, self.ROUTE_FIELD, context)
+        table_route_field = self.parameterAsString(parameters, self.TABLE_ROUTE_FIELD, context)
+        station_field = self.parameterAsString(parameters, self.STATION_FIELD, context)
+        offset_field = self.parameterAsString(parameters, self.OFFSET_FIELD, context)
+        side_field = self.parameterAsString(parameters, self.SIDE_FIELD, context)
+        
+        alignment_crs = alignment.sourceCrs()
+        if alignment.featureCount() != 1 and not route_field:
+            raise QgsProcessingException("Alignment has more than one feature. Only one singlepart feature is allowed unless a Route ID Field is set.")
+        if route_field and not table_route_field:
+            raise QgsProcessingException("A Station Route ID Field is needed when the alignment is a route network.")
+        if QgsWkbTypes.isMultiType(alignment.wkbType()):
+            raise QgsProcessingException("Alignment has multipart geometry. Convert LAYER to single parts.")
+        if alignment_crs.isGeographic():
+            raise QgsProcessingException("Alignment has geographic coordinate system. Convert to planar system.")
+        
+        alignment_request = QgsFeatureRequest()
+        if route_field:
+            alignment_request.setSubsetOfAttributes([route_field], alignment.fields())
+        
+        routes = []
+        for alignment_feature in alignment.getFeatures(alignment_request):
+            alignment_geometry = alignment_feature.geometry()
+            if alignment_geometry.isNull():
+                continue
+            
+            routes.append((alignment_feature.attribute(route_field) if route_field else None, alignment_geometry))
+            continue
+        
+        # Same preprocessed alignment as Linear Reference Events, shared through its cache
+        alignment_hash = alignment_key(alignment_crs.toWkt(), route_field, [(i[0], bytes(i[1].asWkb())) for i in routes])
+        alignment_entry, alignment_origin = cached_alignment(alignment_hash, lambda: build_alignment(route_coordinates(routes)))
+        if alignment_entry is None:
+            raise QgsProcessingException("Alignment has no line with at least two vertices.")
+        
+        route_ids, chainages, segment_index = alignment_entry
+        feedback.pushInfo('Alignment preprocessing: {0}'.format(alignment_origin))
+        
+        # Routes are looked up by the text of their id, the first route wins if an id repeats
+        route_positions = {}
+        for position, route_id in enumerate(route_ids):
+            route_positions.setdefault(str(route_id), position)
+            continue
+        
+        # A Linear Reference Events table already has distance_line, line_x and so on. QgsFields.append drops
+        # a duplicate name, so clashing new fields get a trailing underscore to keep values and columns aligned
+        output_fields = QgsFields(table.fields())
+        for name, variant, type_name, length in (("distance_line", QVariant.Double, "double", 0),
+                                                 ("distance_line_str", QVariant.String, "string", 255),
+                                                 ("offset", QVariant.Double, "double", 0),
+                                                 ("line_x", QVariant.Double, "double", 0),
+                                                 ("line_y", QVariant.Double, "double", 0)):
+            while output_fields.indexOf(name) != -1:
+                name += "_"
+            output_fields.append(QgsField(name, variant, type_name, length))
+            continue
+        
+        (sink, dest_id) = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            output_fields,
+            QgsWkbTypes.Point,
+            alignment_crs
+        )
+        
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        
+        table_fields = table.fields()
+        station_idx = table_fields.indexOf(station_field)
+        offset_idx = table_fields.indexOf(offset_field) if offset_field else -1
+        side_idx = table_fields.indexOf(side_field) if side_field else -1
+        # Without a Route ID Field the alignment is a single route and every station is on it, whatever the table says
+        route_idx = table_fields.indexOf(table_route_field) if route_field and table_route_field else -1
+        
+        total = table.featureCount()
+        placed = 0
+        skipped = 0
+        rows = table.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry))
+        
+        while not feedback.isCanceled():
+            # Rows whose station, route and side are readable are located together, a batch at a time
+            features = []
+            feature_routes = array("q")
+            measures = array("d")
+            offsets = array("d")
+            
+            for feature in rows:
+                attributes = feature.attributes()
+                measure = parse_station(attributes[station_idx])
+                route = route_positions.get(str(attributes[route_idx])) if route_idx > -1 else 0
+                # NULL comes back as a QVariant that is not None, it and unreadable values mean no offset
+                try:
+                    offset = float(attributes[offset_idx]) if offset_idx > -1 else 0.0
+                except (TypeError, ValueError):
+                    offset = 0.0
+                
+                if side_idx > -1:
+                    sign = side_sign(attributes[side_idx])
+                    offset = abs(offset) * sign if sign is not None else 0.0
+                
+                if measure is None or route is None:
+                    skipped += 1
+                    continue
+                
+                features.append(feature)
+                feature_routes.append(route)
+                measures.append(measure)
+                offsets.append(offset)
+                if len(features) >= CHUNK_ROWS:
+                    break
+                continue
+            
+            if not features:
+                break
+            
+            if np is not None:
+                found, xs, ys, line_xs, line_ys = (i.tolist() for i in station_points(segment_index.xs, segment_index.ys, chainages, segment_index.route_starts, feature_routes, measures, offsets))
+            else:
+                found, xs, ys, line_xs, line_ys = station_points_scalar(segment_index.xs, segment_index.ys, chainages, segment_index.route_starts, feature_routes, measures, offsets)
+            
+            batch = []
+            for feature, ok, x, y, line_x, line_y, measure, offset in zip(features, found, xs, ys, line_xs, line_ys, measures, offsets):
+                if not ok:
+                    skipped += 1
+                    continue
+                
+                point = QgsFeature(output_fields)
+                point.setAttributes(feature.attributes() + [measure, distance_fancy_str(measure, None), offset, line_x, line_y])
+                point.setGeometry(QgsGeometry(QgsPoint(x, y)))
+                batch.append(point)
+                continue
+            
+            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+            placed += len(batch)
+            
+            if total > 0:
+                feedback.setProgress(100 * (placed + skipped) / total)
+            continue
+        
+        feedback.pushInfo("Placed {0} stations, skipped {1} unreadable or off the alignment".format(placed, skipped))
+        
+        return {self.OUTPUT: dest_id}
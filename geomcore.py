@@ -0,0 +1,1403 @@
+ # -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Geometry core of the klaw-processing scripts. Works on plain coordinate lists or arrays and imports
+nothing from QGIS, so it runs the same inside a Processing algorithm, a CLI or a service. NumPy is
+optional, every batch routine has a pure Python fallback.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from heapq import heappush, heapreplace
+from math import sqrt, floor, inf
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def measure_along_line(xs, ys, vertex_idx_before, x, y):
+    """
+    Walks the line from its first vertex to the point (x, y). O(V) per call, kept as the
+    reference implementation for measure_along_line_indexed.
+    """
+    distance = 0
+
+    # Handles all segments up to the vertex before the point. At loop termination, vertex_idx is the vertex before the point.
+    vertex_idx = 0
+    while vertex_idx < vertex_idx_before:
+        vxd = xs[vertex_idx] - xs[vertex_idx + 1]
+        vyd = ys[vertex_idx] - ys[vertex_idx + 1]
+        
+        distance += sqrt(vxd ** 2 + vyd ** 2)
+        vertex_idx += 1
+        continue
+    
+    #Final distance addition from last vertex before the point to the point
+    vxd = xs[vertex_idx_before] - x
+    vyd = ys[vertex_idx_before] - y
+    distance += sqrt(vxd ** 2 + vyd ** 2)
+    
+    return distance
+
+def alignment_chainage(xs, ys):
+    """
+    Cumulative distance along the line at each vertex, chainage[i] is the measure of vertex i.
+    """
+    chainage = [0.0]
+    for vertex_idx in range(1, len(xs)):
+        vxd = xs[vertex_idx - 1] - xs[vertex_idx]
+        vyd = ys[vertex_idx - 1] - ys[vertex_idx]
+        
+        chainage.append(chainage[-1] + sqrt(vxd ** 2 + vyd ** 2))
+        continue
+    
+    return chainage
+
+def measure_along_line_indexed(xs, ys, chainage, vertex_idx_before, x, y):
+    """
+    Same result as measure_along_line in O(1), using the prefix sums from alignment_chainage.
+    """
+    vxd = xs[vertex_idx_before] - x
+    vyd = ys[vertex_idx_before] - y
+    
+    return chainage[vertex_idx_before] + sqrt(vxd ** 2 + vyd ** 2)
+    
+# Events projected per tile of the batch engine, and the most cells (tile x segment, or input x near
+# pairs) measured or held at once
+TILE_EVENTS = 128
+BLOCK_CELLS = 1 << 20
+
+# Widest batch engine tile in index cells (a power of two), and the fewest events a tile needs to be worth
+# the array set up. Sparser events go through SegmentIndex.closest_segment one at a time
+TILE_CELLS = 4
+SPARSE_TILE = 8
+
+# Grid cells a SegmentIndex query may cover before it goes to the NumPy arrays instead of the cell dict
+WIDE_QUERY = 64
+
+# Events handed to a worker at a time, and records handed to a sink or writer at a time
+CHUNK_EVENTS = 1 << 16
+WRITE_BATCH = 10000
+
+# Preprocessed alignments kept in memory between runs, and the version of the on-disk layout
+ALIGNMENT_CACHE_SIZE = 8
+CACHE_VERSION = 1
+
+# How far past either end of a route a station may fall. Stations from distance_fancy_str are rounded to
+# whole units, so the end of a route can read up to half a unit long
+STATION_TOLERANCE = 0.5
+
+# qgsDoubleNear default tolerance, used by the closestSegment port below
+DOUBLE_EPSILON = 4 * 2.220446049250313e-16
+
+def double_near(a, b, epsilon = DOUBLE_EPSILON):
+    diff = a - b
+    return diff > -epsilon and diff <= epsilon
+
+def left_of_line(x, y, x1, y1, x2, y2):
+    """
+    Port of QgsGeometryUtils.leftOfLine. Returns -1 if (x, y) is left of the line, 1 if right and 0 if on it.
+    """
+    test = (x - x1) * (y2 - y1) - (y - y1) * (x2 - x1)
+    if double_near(test, 0.0):
+        return 0
+    return -1 if test < 0 else 1
+
+def sqr_dist_to_segment(x, y, x1, y1, x2, y2, epsilon = DOUBLE_EPSILON):
+    """
+    Port of QgsGeometryUtils.sqrDistToLine. Returns (sqrDist, closest x, closest y).
+    """
+    min_x = x1
+    min_y = y1
+    dx = x2 - x1
+    dy = y2 - y1
+    if not double_near(dx, 0.0) or not double_near(dy, 0.0):
+        t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)
+        if t > 1:
+            min_x = x2
+            min_y = y2
+        elif t > 0:
+            min_x += dx * t
+            min_y += dy * t
+    
+    dx = x - min_x
+    dy = y - min_y
+    dist = dx * dx + dy * dy
+    
+    # Prevent rounding errors if the point is directly on the segment
+    if double_near(dist, 0.0, epsilon):
+        return 0.0, x, y
+    return dist, min_x, min_y
+
+def closest_segment(xs, ys, x, y, segment_ids):
+    """
+    Port of QgsLineString.closestSegment restricted to segment_ids, given in ascending order. Segment i runs
+    from vertex i - 1 to vertex i. Returns (sqrDist, (x, y), vertexAfter, leftOf) or None without segments.
+    """
+    sqr_dist = inf
+    left_of_dist = inf
+    left_of = 0
+    prev_left_of = 0
+    prev_left_x = 0.0
+    prev_left_y = 0.0
+    result = None
+    
+    for vertex_idx in segment_ids:
+        prev_x = xs[vertex_idx - 1]
+        prev_y = ys[vertex_idx - 1]
+        current_x = xs[vertex_idx]
+        current_y = ys[vertex_idx]
+        test_dist, segment_x, segment_y = sqr_dist_to_segment(x, y, prev_x, prev_y, current_x, current_y)
+        
+        # A new minimum starts the side test over, so a point on the line is never left with the side of a farther segment
+        if test_dist < sqr_dist:
+            sqr_dist = test_dist
+            result = [sqr_dist, (segment_x, segment_y), vertex_idx]
+            left_of = 0
+            prev_left_of = 0
+            left_of_dist = inf
+        
+        if double_near(test_dist, sqr_dist):
+            left = left_of_line(x, y, prev_x, prev_y, current_x, current_y)
+            # Two segments at equal distance that disagree on the side, test the segments themselves and flip
+            if left != 0:
+                if double_near(test_dist, left_of_dist) and left != prev_left_of and prev_left_of != 0:
+                    left_of = -left_of_line(current_x, current_y, prev_left_x, prev_left_y, prev_x, prev_y)
+                else:
+                    left_of = left
+                prev_left_of = left_of
+                left_of_dist = test_dist
+                prev_left_x = prev_x
+                prev_left_y = prev_y
+            elif test_dist > 0:
+                left_of = 0
+        continue
+    
+    if result is None:
+        return None
+    return result[0], result[1], result[2], left_of
+
+
+class SegmentIndex:
+    """
+    Uniform grid over the bounding boxes of an alignment's segments. closest_segment() returns the same
+    (sqrDist, point, vertexAfter, leftOf) as QgsLineString.closestSegment but only visits nearby segments.
+    With several routes indexed together the nearest segment also picks the nearest route, ties going to
+    the earlier route.
+    """
+
+    def __init__(self, xs, ys, route_starts = (0,)):
+        self.xs = list(xs)
+        self.ys = list(ys)
+        self.cells = {}
+        self.cell_arrays = None
+        
+        # Several routes can share one index, vertex lists back to back. The segment that would join the
+        # last vertex of one route to the first of the next is never indexed
+        self.route_starts = list(route_starts)
+        joins = set(self.route_starts[1:])
+        segment_ids = [i for i in range(1, len(self.xs)) if i not in joins]
+        
+        if len(segment_ids) < 1:
+            self.cell = 1.0
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+            return
+        
+        self.bounds = (min(self.xs), min(self.ys), max(self.xs), max(self.ys))
+        
+        # Mean segment length keeps most segments in one or two cells
+        total_length = 0.0
+        for vertex_idx in segment_ids:
+            total_length += sqrt((self.xs[vertex_idx] - self.xs[vertex_idx - 1]) ** 2 + (self.ys[vertex_idx] - self.ys[vertex_idx - 1]) ** 2)
+            continue
+        self.cell = max(total_length / len(segment_ids), 1e-9)
+        
+        for vertex_idx in segment_ids:
+            x1, x2 = sorted((self.xs[vertex_idx - 1], self.xs[vertex_idx]))
+            y1, y2 = sorted((self.ys[vertex_idx - 1], self.ys[vertex_idx]))
+            for cx in range(floor(x1 / self.cell), floor(x2 / self.cell) + 1):
+                for cy in range(floor(y1 / self.cell), floor(y2 / self.cell) + 1):
+                    self.cells.setdefault((cx, cy), []).append(vertex_idx)
+            continue
+        
+        # Built up front so worker threads only ever read the index
+        if np is not None:
+            keys = sorted(self.cells)
+            sizes = [len(self.cells[i]) for i in keys]
+            self.cell_arrays = (
+                np.array([i[0] for i in keys], dtype = np.int64),
+                np.array([i[1] for i in keys], dtype = np.int64),
+                np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+                np.array([j for i in keys for j in self.cells[i]], dtype = np.int64)
+            )
+
+    @classmethod
+    def from_arrays(cls, xs, ys, route_starts, cell, bounds, cell_arrays):
+        """
+        Wraps the arrays of a saved index, memory-mapped ones included, without copying them or redoing the
+        segment scan. Queries go to the flattened cell arrays, the cell dict is only built if NumPy is gone.
+        """
+        index = cls.__new__(cls)
+        index.xs = xs
+        index.ys = ys
+        index.route_starts = route_starts.tolist()
+        index.cell = cell
+        index.bounds = tuple(bounds)
+        index.cell_arrays = cell_arrays
+        index.cells = None
+        return index
+
+    def route_of(self, vertex_idx):
+        """
+        Position in route_starts of the route holding vertex_idx.
+        """
+        return bisect_right(self.route_starts, vertex_idx) - 1
+
+    def candidates(self, x, y, radius):
+        """
+        Ascending ids of segments whose bounding box may touch the square of half width radius around (x, y).
+        """
+        return self.candidates_in(x - radius, y - radius, x + radius, y + radius)
+
+    def candidates_in(self, xmin, ymin, xmax, ymax):
+        """
+        Ascending ids of segments whose bounding box may touch the given rectangle.
+        """
+        cx1 = floor(xmin / self.cell)
+        cx2 = floor(xmax / self.cell)
+        cy1 = floor(ymin / self.cell)
+        cy2 = floor(ymax / self.cell)
+        
+        # Wide rectangles cost a Python loop per cell, the flattened arrays answer them in one pass. Indexes
+        # loaded from disk have no cell dict and always do
+        if self.cell_arrays is not None and np is not None and (self.cells is None or (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > WIDE_QUERY):
+            return self.candidates_array(xmin, ymin, xmax, ymax).tolist()
+        
+        if self.cells is None:
+            cell_xs, cell_ys, offsets, segment_ids = (i.tolist() for i in self.cell_arrays)
+            self.cells = {key: segment_ids[offsets[i]:offsets[i + 1]] for i, key in enumerate(zip(cell_xs, cell_ys))}
+        
+        found = set()
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.cells):
+            for (cx, cy), segment_ids in self.cells.items():
+                if cx1 <= cx <= cx2 and cy1 <= cy <= cy2:
+                    found.update(segment_ids)
+        else:
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    found.update(self.cells.get((cx, cy), ()))
+        
+        return sorted(found)
+
+    def candidates_array(self, xmin, ymin, xmax, ymax):
+        """
+        NumPy form of candidates_in for the batch engine. The grid is flattened once into cells sorted by
+        column with their segment ids in one array, so a query is a searchsorted plus a vectorised gather.
+        """
+        cell_xs, cell_ys, offsets, segment_ids = self.cell_arrays
+        
+        lo = np.searchsorted(cell_xs, floor(xmin / self.cell), "left")
+        hi = np.searchsorted(cell_xs, floor(xmax / self.cell), "right")
+        cell_y = cell_ys[lo:hi]
+        found = np.nonzero((cell_y >= floor(ymin / self.cell)) & (cell_y <= floor(ymax / self.cell)))[0] + lo
+        
+        starts = offsets[found]
+        sizes = offsets[found + 1] - starts
+        positions = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        return np.unique(segment_ids[positions])
+
+    def closest_segment(self, x, y, max_distance = -1):
+        """
+        Closest segment to (x, y). The search square doubles until it holds a segment at least as close as
+        its half width, so ties are all seen. With max_distance set the square never grows past it and None
+        is returned when no segment is within reach.
+        """
+        xmin, ymin, xmax, ymax = self.bounds
+        covers_all = max(abs(x - xmin), abs(x - xmax), abs(y - ymin), abs(y - ymax))
+        radius = self.cell
+        
+        while True:
+            if max_distance != -1:
+                radius = min(radius, max_distance)
+            
+            if self.cells is None:
+                result = self.closest_gathered(x, y, radius)
+            else:
+                result = closest_segment(self.xs, self.ys, x, y, self.candidates(x, y, radius))
+            if result is not None and sqrt(result[0]) <= radius:
+                return result
+            if max_distance != -1 and radius >= max_distance:
+                return None
+            if radius >= covers_all:
+                return result
+            
+            radius *= 2
+            continue
+
+    def closest_gathered(self, x, y, radius):
+        """
+        closest_segment over the candidates within radius of an index loaded from disk, whose arrays are slow
+        to read an element at a time. The candidates' vertices are gathered into lists first, candidate i
+        running from vertex 2i to 2i + 1, so ascending order and the tie rules carry over.
+        """
+        segment_ids = self.candidates_array(x - radius, y - radius, x + radius, y + radius)
+        pairs = np.stack((segment_ids - 1, segment_ids), axis = 1).ravel()
+        result = closest_segment(self.xs[pairs].tolist(), self.ys[pairs].tolist(), x, y, range(1, len(pairs), 2))
+        if result is None:
+            return None
+        return result[0], result[1], int(segment_ids[result[2] // 2]), result[3]
+
+
+def sqr_dist_to_segments(x, y, x1, y1, x2, y2):
+    """
+    Array form of sqr_dist_to_segment, broadcasting events against segments. Returns (sqrDist, x, y) arrays.
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    degenerate = (dx > -DOUBLE_EPSILON) & (dx <= DOUBLE_EPSILON) & (dy > -DOUBLE_EPSILON) & (dy <= DOUBLE_EPSILON)
+    t = ((x - x1) * dx + (y - y1) * dy) / np.where(degenerate, 1.0, dx * dx + dy * dy)
+    t = np.where(degenerate, 0.0, t)
+    
+    min_x = np.where(t > 1, x2, np.where(t > 0, x1 + dx * t, x1))
+    min_y = np.where(t > 1, y2, np.where(t > 0, y1 + dy * t, y1))
+    dist = (x - min_x) ** 2 + (y - min_y) ** 2
+    
+    on_line = dist <= DOUBLE_EPSILON
+    return np.where(on_line, 0.0, dist), np.where(on_line, x, min_x), np.where(on_line, y, min_y)
+
+def left_of_lines(x, y, x1, y1, x2, y2):
+    """
+    Array form of left_of_line.
+    """
+    test = (x - x1) * (y2 - y1) - (y - y1) * (x2 - x1)
+    return np.where((test > -DOUBLE_EPSILON) & (test <= DOUBLE_EPSILON), 0, np.where(test < 0, -1, 1))
+
+def morton_codes(cx, cy):
+    """
+    Z-order curve position of integer cell coordinates. Sorting by it keeps spatially close cells together,
+    and codes shifted right by 2 * level are the same for all cells of one aligned 2 ** level square.
+    """
+    def spread(v):
+        v = v & np.uint64(0xFFFFFFFF)
+        for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)):
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    
+    cx = (cx - cx.min()).astype(np.uint64)
+    cy = (cy - cy.min()).astype(np.uint64)
+    return spread(cx) | (spread(cy) << np.uint64(1))
+
+def quadtree_tiles(codes, level, sparse_tile):
+    """
+    Splits sorted Z-order codes into runs sharing an aligned square of 2 ** level cells a side, halving any
+    square with more than TILE_EVENTS codes until it fits, or cutting it into TILE_EVENTS runs at one cell.
+    Returns ((start, end) runs, ascending positions of squares with fewer than sparse_tile codes).
+    """
+    runs = []
+    sparse = []
+    squares = [(0, len(codes))]
+    while squares:
+        shift = np.uint64(2 * level)
+        split = []
+        for square_start, square_end in squares:
+            keys = codes[square_start:square_end] >> shift
+            breaks = (np.nonzero(keys[1:] != keys[:-1])[0] + 1 + square_start).tolist()
+            for start, end in zip([square_start] + breaks, breaks + [square_end]):
+                if end - start < sparse_tile:
+                    sparse.extend(range(start, end))
+                elif end - start <= TILE_EVENTS or level == 0:
+                    runs.extend((i, min(i + TILE_EVENTS, end)) for i in range(start, end, TILE_EVENTS))
+                else:
+                    split.append((start, end))
+                continue
+            continue
+        
+        squares = split
+        level -= 1
+        continue
+    
+    sparse.sort()
+    return runs, sparse
+
+def project_points(segment_index, chainages, event_xs, event_ys, max_distance = -1):
+    """
+    Batch form of SegmentIndex.closest_segment plus the chainage lookup. Events are grouped into tiles of at
+    most TILE_EVENTS events and TILE_CELLS index cells across, each measured against only the segments that
+    can hold a nearest point for it. Events too sparse to fill a tile take the scalar search, as long as the
+    line is near them.
+    Returns arrays (hit, distance_away, distance_line, line_x, line_y, side_of_line, vertex_after).
+    """
+    xs = np.asarray(segment_index.xs, dtype = float)
+    ys = np.asarray(segment_index.ys, dtype = float)
+    event_xs = np.asarray(event_xs, dtype = float)
+    event_ys = np.asarray(event_ys, dtype = float)
+    
+    count = len(event_xs)
+    sqr_dist = np.full(count, inf)
+    line_x = np.zeros(count)
+    line_y = np.zeros(count)
+    vertex_after = np.zeros(count, dtype = np.int64)
+    ties = {}
+    sides = {}
+    
+    tiles = []
+    sparse = []
+    bxmin, bymin, bxmax, bymax = segment_index.bounds
+    if count and len(xs) > 1:
+        # Z-ordered index cells split into a quadtree of tiles, see quadtree_tiles. Tiles are never wide
+        # however sparse the events are, too sparse ones are left to the scalar search
+        codes = morton_codes(np.floor(event_xs / segment_index.cell).astype(np.int64), np.floor(event_ys / segment_index.cell).astype(np.int64))
+        order = np.argsort(codes, kind = "stable")
+        codes = codes[order]
+        level = TILE_CELLS.bit_length() - 1
+        runs, sparse = quadtree_tiles(codes, level, SPARSE_TILE)
+        tiles.extend(order[start:end] for start, end in runs)
+        
+        # Sparse events look for a segment within a tile width one at a time. The few with none that close
+        # would each scan a wide square in Python, they go back to tiles of their own
+        limit = segment_index.cell * TILE_CELLS
+        if max_distance != -1:
+            limit = min(limit, max_distance)
+        
+        far = []
+        sparse_idx = order[sparse]
+        for position, event_idx, ex, ey in zip(sparse, sparse_idx.tolist(), event_xs[sparse_idx].tolist(), event_ys[sparse_idx].tolist()):
+            result = segment_index.closest_segment(ex, ey, limit)
+            if result is not None:
+                sqr_dist[event_idx] = result[0]
+                line_x[event_idx], line_y[event_idx] = result[1]
+                vertex_after[event_idx] = result[2]
+                sides[event_idx] = result[3]
+            # Nothing within the limit itself is a miss, not a far event
+            elif limit != max_distance:
+                far.append(position)
+            continue
+        
+        far = np.array(far, dtype = np.int64)
+        runs = quadtree_tiles(codes[far], level, 1)[0]
+        tiles.extend(order[far[start:end]] for start, end in runs)
+    
+    for tile in tiles:
+        px = event_xs[tile]
+        py = event_ys[tile]
+        txmin, txmax, tymin, tymax = px.min(), px.max(), py.min(), py.max()
+        half_diagonal = sqrt((txmax - txmin) ** 2 + (tymax - tymin) ** 2) / 2
+        
+        # Any segment bounds each event's nearest distance from above. The square around the tile centre
+        # doubles until it touches one, the largest bound it gives is then how far the tile has to look. With
+        # a limit the square stops at it plus the half diagonal, past which no event can have a segment
+        centre_x = (txmin + txmax) / 2
+        centre_y = (tymin + tymax) / 2
+        covers_all = max(abs(centre_x - bxmin), abs(centre_x - bxmax), abs(centre_y - bymin), abs(centre_y - bymax))
+        radius = segment_index.cell
+        while True:
+            if max_distance != -1:
+                radius = min(radius, max_distance + half_diagonal)
+            
+            segment_ids = segment_index.candidates_array(centre_x - radius, centre_y - radius, centre_x + radius, centre_y + radius)
+            if len(segment_ids) or radius >= covers_all or (max_distance != -1 and radius >= max_distance + half_diagonal):
+                break
+            
+            radius *= 2
+            continue
+        
+        if len(segment_ids) == 0:
+            continue
+        
+        ids = segment_ids[:BLOCK_CELLS // len(tile)]
+        reach = sqrt(sqr_dist_to_segments(px[:, None], py[:, None], xs[ids - 1], ys[ids - 1], xs[ids], ys[ids])[0].min(axis = 1).max())
+        if max_distance != -1:
+            reach = min(reach, max_distance)
+        
+        segment_ids = segment_index.candidates_array(txmin - reach, tymin - reach, txmax + reach, tymax + reach)
+        if len(segment_ids) == 0:
+            continue
+        
+        rows = np.arange(len(tile))
+        best = np.full(len(tile), inf)
+        best_x = np.zeros(len(tile))
+        best_y = np.zeros(len(tile))
+        best_after = np.zeros(len(tile), dtype = np.int64)
+        block = max(1, BLOCK_CELLS // len(tile))
+        
+        # Candidates are ascending and only a strictly smaller distance wins, same tie rule as closest_segment
+        for block_start in range(0, len(segment_ids), block):
+            ids = segment_ids[block_start:block_start + block]
+            dist, min_x, min_y = sqr_dist_to_segments(px[:, None], py[:, None], xs[ids - 1], ys[ids - 1], xs[ids], ys[ids])
+            nearest = np.argmin(dist, axis = 1)
+            nearest_dist = dist[rows, nearest]
+            better = nearest_dist < best
+            best = np.where(better, nearest_dist, best)
+            best_x = np.where(better, min_x[rows, nearest], best_x)
+            best_y = np.where(better, min_y[rows, nearest], best_y)
+            best_after = np.where(better, ids[nearest], best_after)
+            continue
+        
+        # Later segments at an equal distance (foot on a shared, repeated or overlapping vertex) take part in
+        # the side test. The few events with such ties replay it through closest_segment afterwards
+        for block_start in range(0, len(segment_ids), block):
+            if len(segment_ids) > block:
+                ids = segment_ids[block_start:block_start + block]
+                dist = sqr_dist_to_segments(px[:, None], py[:, None], xs[ids - 1], ys[ids - 1], xs[ids], ys[ids])[0]
+            
+            diff = dist - best[:, None]
+            equal = (diff > -DOUBLE_EPSILON) & (diff <= DOUBLE_EPSILON) & (ids[None, :] > best_after[:, None])
+            for row in np.nonzero(equal.any(axis = 1))[0].tolist():
+                ties.setdefault(int(tile[row]), [int(best_after[row])]).extend(ids[equal[row]].tolist())
+                continue
+            continue
+        
+        sqr_dist[tile] = best
+        line_x[tile] = best_x
+        line_y[tile] = best_y
+        vertex_after[tile] = best_after
+        continue
+    
+    distance_away = np.sqrt(sqr_dist)
+    hit = vertex_after > 0
+    if max_distance != -1:
+        hit &= distance_away <= max_distance
+    
+    after = np.where(hit, vertex_after, 1)
+    side_of_line = left_of_lines(event_xs, event_ys, xs[after - 1], ys[after - 1], xs[after], ys[after])
+    for event_idx, segment_ids in ties.items():
+        side_of_line[event_idx] = closest_segment(segment_index.xs, segment_index.ys, event_xs[event_idx], event_ys[event_idx], sorted(segment_ids))[3]
+        continue
+    for event_idx, side in sides.items():
+        side_of_line[event_idx] = side
+        continue
+    
+    distance_line = np.asarray(chainages, dtype = float)[after - 1] + np.hypot(line_x - xs[after - 1], line_y - ys[after - 1])
+    
+    return hit, distance_away, distance_line, line_x, line_y, side_of_line, vertex_after
+
+def project_events(segment_index, chainages, event_xs, event_ys, max_distance = -1):
+    """
+    Projects events onto the alignment. Returns a (distance_away, distance_line, line_x, line_y, side_of_line, vertex_after)
+    tuple per event, None where no segment is within max_distance. Uses the NumPy batch engine when available.
+    """
+    if np is not None:
+        hit, distance_away, distance_line, line_x, line_y, side_of_line, vertex_after = project_points(segment_index, chainages, event_xs, event_ys, max_distance)
+        return [i[1:] if i[0] else None for i in zip(hit.tolist(), distance_away.tolist(), distance_line.tolist(), line_x.tolist(), line_y.tolist(), side_of_line.tolist(), vertex_after.tolist())]
+    
+    projections = []
+    for ex, ey in zip(event_xs, event_ys):
+        results = segment_index.closest_segment(ex, ey, max_distance)
+        if results is None:
+            projections.append(None)
+            continue
+        
+        line_x, line_y = results[1]
+        distance_on_line = measure_along_line_indexed(segment_index.xs, segment_index.ys, chainages, results[2] - 1, line_x, line_y)
+        projections.append((sqrt(results[0]), distance_on_line, line_x, line_y, results[3], results[2]))
+        continue
+    
+    return projections
+    
+def distance_fancy_str(distance, unit, modulo = 100):
+    first = int(distance / modulo)
+    second = round(distance % modulo)
+    return f"{first}+{second}"
+
+def parse_station(value, modulo = 100):
+    """
+    Measure of a station value, the inverse of distance_fancy_str: "12+50" is 12 * modulo + 50. Plain
+    numbers pass through. Returns None for NULL or unreadable values.
+    """
+    if value is None:
+        return None
+    
+    if isinstance(value, (int, float)):
+        return float(value)
+    
+    text = str(value).strip().replace(",", "")
+    try:
+        if "+" in text:
+            first, second = text.split("+", 1)
+            return float(first) * modulo + float(second)
+        return float(text)
+    except ValueError:
+        return None
+
+def alignment_key(crs_wkt, route_field, routes):
+    """
+    Cache key of a preprocessed alignment. SHA-1 over the cache version, the CRS, the route field and the
+    route id and geometry bytes (WKB) of every (route_id, geometry_bytes) in read order.
+    """
+    key = hashlib.sha1("{0}|{1}|{2}".format(CACHE_VERSION, crs_wkt, route_field).encode())
+    for route_id, geometry_bytes in routes:
+        key.update(repr(route_id).encode())
+        key.update(geometry_bytes)
+        continue
+    return key.hexdigest()
+
+def build_alignment(routes):
+    """
+    Builds (route_ids, chainages, segment_index) from (route_id, xs, ys) routes, None if no route has two
+    vertices. Every route's vertices go back to back in one list, chainage restarts at zero for each route.
+    """
+    route_ids = []
+    route_starts = []
+    alignment_xs = []
+    alignment_ys = []
+    alignment_chainages = []
+    
+    for route_id, xs, ys in routes:
+        if len(xs) < 2:
+            continue
+        
+        route_ids.append(route_id)
+        route_starts.append(len(alignment_xs))
+        alignment_xs.extend(xs)
+        alignment_ys.extend(ys)
+        alignment_chainages.extend(alignment_chainage(xs, ys))
+        continue
+    
+    if not route_starts:
+        return None
+    
+    return route_ids, alignment_chainages, SegmentIndex(alignment_xs, alignment_ys, route_starts)
+
+def save_alignment(path, route_ids, chainages, segment_index):
+    """
+    Writes a preprocessed alignment to a folder of .npy arrays and a JSON header. The folder is filled under
+    a temporary name and renamed into place, so a reader never sees half an entry.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok = True)
+    staging = tempfile.mkdtemp(dir = parent)
+    
+    cell_xs, cell_ys, offsets, segment_ids = segment_index.cell_arrays
+    arrays = {
+        "xs": np.asarray(segment_index.xs, dtype = float),
+        "ys": np.asarray(segment_index.ys, dtype = float),
+        "chainages": np.asarray(chainages, dtype = float),
+        "route_starts": np.asarray(segment_index.route_starts, dtype = np.int64),
+        "cell_xs": cell_xs,
+        "cell_ys": cell_ys,
+        "offsets": offsets,
+        "segment_ids": segment_ids
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(staging, name + ".npy"), values)
+        continue
+    
+    with open(os.path.join(staging, "header.json"), "w") as header:
+        json.dump({"version": CACHE_VERSION, "cell": segment_index.cell, "bounds": segment_index.bounds, "route_ids": route_ids}, header, default = str)
+    
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another run wrote the same entry first
+        shutil.rmtree(staging, ignore_errors = True)
+
+def load_alignment(path):
+    """
+    Reads a folder written by save_alignment with its arrays memory-mapped. Returns (route_ids, chainages,
+    segment_index), None if there is no readable entry of the current version.
+    """
+    try:
+        with open(os.path.join(path, "header.json")) as header:
+            header = json.load(header)
+        if header["version"] != CACHE_VERSION:
+            return None
+        # Plain ndarray views of the maps, still backed by the files. memmap's own indexing goes through Python
+        arrays = {i: np.asarray(np.load(os.path.join(path, i + ".npy"), mmap_mode = "r")) for i in ("xs", "ys", "chainages", "route_starts", "cell_xs", "cell_ys", "offsets", "segment_ids")}
+    except (OSError, ValueError, KeyError):
+        return None
+    
+    cell_arrays = tuple(arrays[i] for i in ("cell_xs", "cell_ys", "offsets", "segment_ids"))
+    segment_index = SegmentIndex.from_arrays(arrays["xs"], arrays["ys"], arrays["route_starts"], header["cell"], header["bounds"], cell_arrays)
+    return header["route_ids"], arrays["chainages"], segment_index
+
+ALIGNMENT_CACHE = OrderedDict()
+ALIGNMENT_CACHE_LOCK = Lock()
+
+def cached_alignment(key, build, cache_dir = ""):
+    """
+    Preprocessed alignment for key, taken from the in-memory LRU, else from cache_dir, else made by calling
+    build() and stored in both. Returns (entry, origin) with origin "memory", "disk" or "built", entry None
+    when build() finds no usable route. Entries are never modified, so runs can share them.
+    """
+    with ALIGNMENT_CACHE_LOCK:
+        entry = ALIGNMENT_CACHE.get(key)
+        if entry is not None:
+            ALIGNMENT_CACHE.move_to_end(key)
+            return entry, "memory"
+    
+    origin = "built"
+    entry = None
+    path = os.path.join(cache_dir, key) if cache_dir and np is not None else ""
+    if path:
+        entry = load_alignment(path)
+        origin = "disk"
+    
+    if entry is None:
+        origin = "built"
+        entry = build()
+        if entry is None:
+            return None, origin
+        if path:
+            save_alignment(path, *entry)
+    
+    with ALIGNMENT_CACHE_LOCK:
+        ALIGNMENT_CACHE[key] = entry
+        ALIGNMENT_CACHE.move_to_end(key)
+        while len(ALIGNMENT_CACHE) > ALIGNMENT_CACHE_SIZE:
+            ALIGNMENT_CACHE.popitem(last = False)
+    
+    return entry, origin
+
+def event_fingerprints(run_key, event_layers):
+    """
+    SHA-1 per event id over run_key and the layer name, coordinates and comment of every vertex carrying
+    that id, in read order. event_layers holds (name, xs, ys, GUIDs, comments). Vertices without a GUID ("-")
+    have no identity to track and get no fingerprint.
+    """
+    fingerprints = {}
+    for event_name, event_xs, event_ys, event_ids, event_comments in event_layers:
+        for ex, ey, eid, comment in zip(event_xs, event_ys, event_ids, event_comments):
+            eid = str(eid)
+            if eid == "-":
+                continue
+            
+            fingerprint = fingerprints.get(eid)
+            if fingerprint is None:
+                fingerprint = fingerprints[eid] = hashlib.sha1(run_key.encode())
+            fingerprint.update(repr((event_name, ex, ey, str(comment))).encode())
+            continue
+        continue
+    
+    return {eid: fingerprint.hexdigest() for eid, fingerprint in fingerprints.items()}
+
+def consolidate_record(groups, event_id, record, distance_on_line):
+    """
+    Streaming group-by on (route, event_id). Keeps [count, min record, min measure, max record, max measure] per id,
+    ties resolve to the earliest record for the minimum and the latest for the maximum.
+    """
+    group = groups.get(event_id)
+    if group is None:
+        groups[event_id] = [1, record, distance_on_line, record, distance_on_line]
+        return
+    
+    group[0] += 1
+    if distance_on_line < group[2]:
+        group[1] = record
+        group[2] = distance_on_line
+    if distance_on_line >= group[4]:
+        group[3] = record
+        group[4] = distance_on_line
+
+def extend_range(ranges, key, distance_on_line):
+    """
+    Streaming min / max measure per (route position, event_id) for the linear event output.
+    """
+    span = ranges.get(key)
+    if span is None:
+        ranges[key] = [distance_on_line, distance_on_line]
+        return
+    
+    span[0] = min(span[0], distance_on_line)
+    span[1] = max(span[1], distance_on_line)
+
+def point_at_measure(xs, ys, chainages, vertex_idx_after, measure):
+    """
+    Point at measure on the segment that ends at vertex_idx_after.
+    """
+    v1 = vertex_idx_after - 1
+    span = chainages[vertex_idx_after] - chainages[v1]
+    along = (measure - chainages[v1]) / span if span > 0 else 0.0
+    return xs[v1] + (xs[vertex_idx_after] - xs[v1]) * along, ys[v1] + (ys[vertex_idx_after] - ys[v1]) * along
+
+def cut_ranges(xs, ys, chainages, route_starts, ranges):
+    """
+    Alignment substrings of (route position, from_measure, to_measure) ranges, as (xs, ys) vertex lists in
+    the order given. Ranges are visited by route and from_measure so the vertex cursor only ever moves
+    forward, one sweep cuts them all instead of a substring walk per range.
+    """
+    route_ends = list(route_starts[1:]) + [len(xs)]
+    lines = [None] * len(ranges)
+    current_route = None
+    cursor = 0
+    
+    for range_idx in sorted(range(len(ranges)), key = lambda i: ranges[i][:2]):
+        route, from_measure, to_measure = ranges[range_idx]
+        start, end = route_starts[route], route_ends[route]
+        if route != current_route:
+            current_route = route
+            cursor = start + 1
+        
+        # cursor ends on the segment holding from_measure, the first vertex past it
+        while cursor < end - 1 and chainages[cursor] <= from_measure:
+            cursor += 1
+            continue
+        
+        x, y = point_at_measure(xs, ys, chainages, cursor, from_measure)
+        line_xs = [x]
+        line_ys = [y]
+        
+        vertex_idx = cursor
+        while vertex_idx < end - 1 and chainages[vertex_idx] < to_measure:
+            line_xs.append(xs[vertex_idx])
+            line_ys.append(ys[vertex_idx])
+            vertex_idx += 1
+            continue
+        
+        x, y = point_at_measure(xs, ys, chainages, vertex_idx, to_measure)
+        line_xs.append(x)
+        line_ys.append(y)
+        lines[range_idx] = (line_xs, line_ys)
+        continue
+    
+    return lines
+
+def route_extents(chainages, route_starts, vertex_count):
+    """
+    (starts, ends, lengths) of every route in a concatenated vertex list, ends exclusive.
+    """
+    starts = list(route_starts)
+    ends = starts[1:] + [vertex_count]
+    lengths = [chainages[i - 1] for i in ends]
+    return starts, ends, lengths
+
+def station_points(xs, ys, chainages, route_starts, routes, measures, offsets):
+    """
+    Locates measures along routes (positions in route_starts) with one binary search over the chainage of
+    all routes, then offsets them square to the alignment, positive to the right and negative to the left.
+    Returns arrays (found, x, y, line_x, line_y), found is False where the measure is off its route.
+    """
+    xs = np.asarray(xs, dtype = float)
+    ys = np.asarray(ys, dtype = float)
+    chainages = np.asarray(chainages, dtype = float)
+    starts, ends, lengths = (np.asarray(i) for i in route_extents(chainages, route_starts, len(xs)))
+    
+    # One ascending key over every route, each route's chainage shifted past the end of the one before
+    bases = np.concatenate(([0.0], np.cumsum(lengths + 1.0)[:-1]))
+    keys = chainages + np.repeat(bases, ends - starts)
+    
+    routes = np.asarray(routes, dtype = np.int64)
+    measures = np.asarray(measures, dtype = float)
+    offsets = np.asarray(offsets, dtype = float)
+    route_lengths = lengths[routes]
+    found = (measures >= -STATION_TOLERANCE) & (measures <= route_lengths + STATION_TOLERANCE)
+    measures = np.clip(measures, 0.0, route_lengths)
+    
+    after = np.searchsorted(keys, measures + bases[routes], "right")
+    after = np.clip(after, starts[routes] + 1, ends[routes] - 1)
+    
+    dx = xs[after] - xs[after - 1]
+    dy = ys[after] - ys[after - 1]
+    length = np.hypot(dx, dy)
+    scale = np.divide(1.0, length, out = np.zeros_like(length), where = length > 0)
+    along = (measures - chainages[after - 1]) * scale
+    
+    # The left normal of a segment is (-dy, dx), a positive offset goes the other way
+    line_x = xs[after - 1] + dx * along
+    line_y = ys[after - 1] + dy * along
+    x = line_x + dy * scale * offsets
+    y = line_y - dx * scale * offsets
+    return found, x, y, line_x, line_y
+
+def station_points_scalar(xs, ys, chainages, route_starts, routes, measures, offsets):
+    """
+    station_points without NumPy, one bisect per measure. Returns lists of the same arrays.
+    """
+    starts, ends, lengths = route_extents(chainages, route_starts, len(xs))
+    results = ([], [], [], [], [])
+    
+    for route, measure, offset in zip(routes, measures, offsets):
+        start, end, route_length = starts[route], ends[route], lengths[route]
+        found = -STATION_TOLERANCE <= measure <= route_length + STATION_TOLERANCE
+        measure = min(max(measure, 0.0), route_length)
+        
+        after = bisect_right(chainages, measure, start, end)
+        after = min(max(after, start + 1), end - 1)
+        
+        dx = xs[after] - xs[after - 1]
+        dy = ys[after] - ys[after - 1]
+        length = sqrt(dx ** 2 + dy ** 2)
+        scale = 1.0 / length if length > 0 else 0.0
+        along = (measure - chainages[after - 1]) * scale
+        
+        line_x = xs[after - 1] + dx * along
+        line_y = ys[after - 1] + dy * along
+        for values, value in zip(results, (found, line_x + dy * scale * offset, line_y - dx * scale * offset, line_x, line_y)):
+            values.append(value)
+        continue
+    
+    return results
+
+def side_sign(side):
+    """
+    Offset sign of a side_of_line value: -1 for Left, 1 for Right, None for anything else.
+    """
+    side = str(side).strip().lower() if side is not None else ""
+    if side.startswith("l"):
+        return -1
+    if side.startswith("r"):
+        return 1
+    return None
+
+def nearest_points(input_xy, near_xy, k_nearest = 0, max_distance = -1):
+    """
+    Distance block of (n, 2) input points against (m, 2) near points. Returns arrays (input_idx, near_idx,
+    distance) row by row, each row's near points in layer order. With k_nearest > 0 or a max_distance, rows
+    are the indexed path's instead: closest first, ties in layer order, at most k_nearest of them. Pairs
+    beyond max_distance are dropped unless it is -1.
+    """
+    near_count = len(near_xy)
+    distances = np.hypot(input_xy[:, 0, None] - near_xy[None, :, 0], input_xy[:, 1, None] - near_xy[None, :, 1])
+    
+    if k_nearest > 0 and k_nearest < near_count:
+        # argpartition picks an arbitrary subset of the pairs tied at the k-th distance. Everything closer is
+        # kept, the tied pairs fill the rest in layer order, then each row is sorted stable by distance
+        kth = np.partition(distances, k_nearest - 1, axis = 1)[:, k_nearest - 1, None]
+        tied = distances == kth
+        room = k_nearest - np.count_nonzero(distances < kth, axis = 1)
+        selected = (distances < kth) | (tied & (np.cumsum(tied, axis = 1) <= room[:, None]))
+        order = np.nonzero(selected)[1].reshape(-1, k_nearest)
+        order = np.take_along_axis(order, np.argsort(np.take_along_axis(distances, order, axis = 1), axis = 1, kind = "stable"), axis = 1)
+    elif k_nearest > 0 or max_distance != -1:
+        order = np.argsort(distances, axis = 1, kind = "stable")
+    else:
+        order = np.broadcast_to(np.arange(near_count), distances.shape)
+    
+    selected = np.take_along_axis(distances, order, axis = 1)
+    if max_distance != -1:
+        keep_rows, keep_cols = np.nonzero(selected <= max_distance)
+    else:
+        keep_rows, keep_cols = np.nonzero(np.ones(selected.shape, dtype = bool))
+    
+    return keep_rows, order[keep_rows, keep_cols], selected[keep_rows, keep_cols]
+
+def envelope_distances(box, boxes):
+    """
+    Distance from the envelope box (xmin, ymin, xmax, ymax) to each row of the (n, 4) boxes, 0 where they
+    overlap. Never more than the distance between the geometries they bound, so a lower bound for it.
+    """
+    dx = np.maximum(0.0, np.maximum(boxes[:, 0] - box[2], box[0] - boxes[:, 2]))
+    dy = np.maximum(0.0, np.maximum(boxes[:, 1] - box[3], box[1] - boxes[:, 3]))
+    return np.hypot(dx, dy)
+
+def bounded_nearest(ids, bounds, exact, k_nearest = 0, max_distance = -1):
+    """
+    Branch and bound over candidate ids with lower bounds from envelope_distances, bounds[i] belonging to
+    ids[i]. exact(id) is the true distance and is only called where it can change the result: never past
+    max_distance, and with k_nearest > 0 candidates go closest bound first until a bound exceeds the k-th
+    best distance. Returns ([(distance, id)] sorted by distance then id, the number of exact calls), the
+    pairs and tie order a measure of every candidate would give.
+    """
+    ids = np.asarray(ids, dtype = np.int64)
+    bounds = np.asarray(bounds, dtype = float)
+    if max_distance != -1:
+        keep = bounds <= max_distance
+        ids = ids[keep]
+        bounds = bounds[keep]
+    
+    found = []
+    evaluated = 0
+    if k_nearest <= 0:
+        for idx in ids.tolist():
+            distance = exact(idx)
+            evaluated += 1
+            if max_distance == -1 or distance <= max_distance:
+                found.append((distance, idx))
+            continue
+        found.sort()
+        return found, evaluated
+    
+    # Only the closest bounds are ordered up front, argpartition leaves the rest unsorted behind them and
+    # they are only sorted when the first ones did not settle the k best
+    head = min(len(ids), 4 * k_nearest)
+    if head < len(ids):
+        part = np.argpartition(bounds, head - 1)
+        blocks = [part[:head], part[head:]]
+    else:
+        blocks = [np.arange(len(ids))]
+    
+    # Max heap of the k best as (-distance, -id), its top is the pair to beat. A bound equal to that
+    # distance is still measured, an equal distance with a lower id wins the tie
+    for block in blocks:
+        block = block[np.lexsort((ids[block], bounds[block]))]
+        stopped = False
+        for idx, bound in zip(ids[block].tolist(), bounds[block].tolist()):
+            if len(found) == k_nearest and bound > -found[0][0]:
+                stopped = True
+                break
+            
+            distance = exact(idx)
+            evaluated += 1
+            if max_distance != -1 and distance > max_distance:
+                continue
+            
+            if len(found) < k_nearest:
+                heappush(found, (-distance, -idx))
+            elif (-distance, -idx) > found[0]:
+                heapreplace(found, (-distance, -idx))
+            continue
+        
+        if stopped:
+            break
+        continue
+    
+    found = sorted((-i[0], -i[1]) for i in found)
+    return found, evaluated
+
+def ordered_map(executor, func, items, window):
+    """
+    Like executor.map but yields (item, result) in submission order, keeps at most window items in flight
+    and cancels the rest on early exit.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for item, future in pending:
+            future.cancel()
+
+# Bytes reserved for the header of a streamed .npy file, room for any 2D shape
+NPY_HEADER_BYTES = 128
+
+def npy_header(dtype, shape):
+    """
+    Version 1.0 .npy header padded to exactly NPY_HEADER_BYTES, so it can be written over the space
+    reserved for it once the length of the array is known.
+    """
+    text = "{{'descr': '{0}', 'fortran_order': False, 'shape': {1}, }}".format(np.dtype(dtype).str, repr(tuple(shape)))
+    size = NPY_HEADER_BYTES - 10
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", size) + text.ljust(size - 1).encode("latin1") + b"\n"
+
+class NpyStream:
+    """
+    Appends blocks of rows to a .npy file whose length is only known at close(). Nothing but the
+    current block is held in memory.
+    """
+
+    def __init__(self, path, dtype, row_shape = ()):
+        self.handle = open(path, "wb")
+        self.handle.write(bytes(NPY_HEADER_BYTES))
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.count = 0
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype = self.dtype)
+        self.handle.write(values.tobytes())
+        self.count += len(values)
+
+    def close(self):
+        self.handle.seek(0)
+        self.handle.write(npy_header(self.dtype, (self.count,) + self.row_shape))
+        self.handle.close()
+
+
+class NearMatrixWriter:
+    """
+    Near matrix as a folder of .npy arrays NumPy can memory map, one row per input and one column per
+    near feature, with the ids of both in JSON:
+
+        matrix.json     format (dense or csr), shape, dtype and the query settings
+        input_ids.json  row ids, near_ids.json column ids
+        distances.npy   dense, float32 (rows, columns)
+        data.npy, indices.npy, indptr.npy   csr, as scipy.sparse.csr_matrix takes them
+
+    Dense suits full matrices of small inputs, csr anything cut by a count or distance limit. A csr row
+    lists its pairs in the order of the table output.
+    """
+
+    def __init__(self, folder, near_ids, dense, settings = None):
+        os.makedirs(folder, exist_ok = True)
+        self.folder = folder
+        self.near_ids = list(near_ids)
+        self.dense = dense
+        self.settings = settings or {}
+        self.input_ids = []
+        
+        near_count = len(self.near_ids)
+        if dense:
+            self.distances = NpyStream(os.path.join(folder, "distances.npy"), np.float32, (near_count,))
+        else:
+            self.indptr = [np.zeros(1, dtype = np.int64)]
+            self.pairs = 0
+            self.indices = NpyStream(os.path.join(folder, "indices.npy"), np.int32 if near_count < 2 ** 31 else np.int64)
+            self.data = NpyStream(os.path.join(folder, "data.npy"), np.float32)
+
+    def add_rows(self, input_ids, rows, near_positions, distances):
+        """
+        Appends a block of len(input_ids) rows. rows, near_positions and distances are the pairs of the
+        block, rows counted from the start of the block and in ascending order.
+        """
+        rows = np.asarray(rows, dtype = np.int64)
+        if self.dense:
+            # Pairs a limit left out are nan, a full matrix has none
+            block = np.full((len(input_ids), len(self.near_ids)), np.nan, dtype = np.float32)
+            block[rows, np.asarray(near_positions, dtype = np.int64)] = distances
+            self.distances.append(block)
+        else:
+            self.indices.append(near_positions)
+            self.data.append(distances)
+            self.indptr.append(self.pairs + np.cumsum(np.bincount(rows, minlength = len(input_ids))))
+            self.pairs += len(rows)
+        self.input_ids.extend(input_ids)
+
+    def close(self):
+        if self.dense:
+            self.distances.close()
+            files = ["distances.npy"]
+        else:
+            self.indices.close()
+            self.data.close()
+            np.save(os.path.join(self.folder, "indptr.npy"), np.concatenate(self.indptr))
+            files = ["data.npy", "indices.npy", "indptr.npy"]
+        
+        for name, ids in (("input_ids.json", self.input_ids), ("near_ids.json", self.near_ids)):
+            with open(os.path.join(self.folder, name), "w") as handle:
+                json.dump(ids, handle, default = str)
+            continue
+        
+        header = {"format": "dense" if self.dense else "csr", "shape": [len(self.input_ids), len(self.near_ids)], "dtype": "float32", "files": files}
+        header.update(self.settings)
+        with open(os.path.join(self.folder, "matrix.json"), "w") as handle:
+            json.dump(header, handle, indent = 2, default = str)
+
+def load_near_matrix(folder, mmap_mode = "r"):
+    """
+    (input_ids, near_ids, matrix) of a NearMatrixWriter folder. matrix is the memory mapped dense array
+    or a (data, indices, indptr) tuple, scipy.sparse.csr_matrix(matrix, shape) builds on it without a copy.
+    """
+    with open(os.path.join(folder, "matrix.json")) as handle:
+        header = json.load(handle)
+    
+    ids = []
+    for name in ("input_ids.json", "near_ids.json"):
+        with open(os.path.join(folder, name)) as handle:
+            ids.append(json.load(handle))
+        continue
+    
+    arrays = tuple(np.load(os.path.join(folder, i), mmap_mode = mmap_mode) for i in header["files"])
+    return ids[0], ids[1], arrays[0] if header["format"] == "dense" else arrays
+
+# Seconds between progress updates, and between stack samples of the profiler
+PROGRESS_INTERVAL = 0.2
+SAMPLE_INTERVAL = 0.005
+
+# Functions listed per table of the profile report
+PROFILE_TOP = 25
+
+class Progress:
+    """
+    Rate limited progress over total items. advance() forwards a percentage to report at most every
+    PROGRESS_INTERVAL seconds and only when it moved, finish() always reports 100.
+    """
+
+    def __init__(self, report, total, interval = PROGRESS_INTERVAL):
+        self.report = report
+        self.total = max(total, 0)
+        self.interval = interval
+        self.done = 0
+        self.last_percent = -1.0
+        self.last_time = 0.0
+
+    def advance(self, count):
+        self.done += count
+        now = time.perf_counter()
+        if now - self.last_time < self.interval:
+            return
+        
+        percent = min(100.0, 100.0 * self.done / self.total) if self.total > 0 else 100.0
+        if percent != self.last_percent:
+            self.report(percent)
+            self.last_percent = percent
+            self.last_time = now
+
+    def finish(self):
+        self.done = self.total
+        self.last_percent = 100.0
+        self.report(100.0)
+
+
+class Sampler:
+    """
+    Statistical profiler. A daemon thread reads the Python stack of the watched threads every interval
+    seconds, the calling thread and the worker pools, and counts each function once per sample where it
+    is running (self) and where it is on the stack (total). Unlike cProfile it sees the worker threads
+    and costs about the same whatever the hot loop calls.
+    """
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.owner = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = "geomcore-sampler", daemon = True)
+
+    def watched(self):
+        pools = {i.ident for i in threading.enumerate() if i.name.startswith("ThreadPoolExecutor")}
+        pools.add(self.owner)
+        return pools
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            watched = self.watched()
+            for ident, frame in sys._current_frames().items():
+                if ident not in watched:
+                    continue
+                
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = "{0}:{1}({2})".format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+                    if top:
+                        self.self_counts[key] += 1
+                        top = False
+                    if key not in seen:
+                        self.total_counts[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+                    continue
+                
+                self.samples += 1
+                continue
+            continue
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def report(self, top = PROFILE_TOP):
+        """
+        Sample count and the top functions by self and total share of the samples.
+        """
+        samples = max(self.samples, 1)
+        return {
+            "interval": self.interval,
+            "samples": self.samples,
+            "self": [{"function": i, "samples": count, "share": count / samples} for i, count in self.self_counts.most_common(top)],
+            "total": [{"function": i, "samples": count, "share": count / samples} for i, count in self.total_counts.most_common(top)],
+        }
+
+
+class Metrics:
+    """
+    Phase timers and counters of one run, safe to update from worker threads. Phase seconds add up over
+    every call, so a phase timed on the workers reports thread seconds, not wall time. With profile set a
+    Sampler runs between start() and stop().
+    """
+
+    def __init__(self, name, profile = False):
+        self.name = name
+        self.lock = Lock()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.settings = OrderedDict()
+        self.sampler = Sampler() if profile else None
+        self.started = None
+        self.last_lap = None
+        self.seconds = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.last_lap = self.started
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.started
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    @contextmanager
+    def phase(self, name):
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - phase_started)
+
+    def timed(self, name, func):
+        """
+        func wrapped to add its run time to phase name, for work handed to a pool.
+        """
+        def run(*args):
+            with self.phase(name):
+                return func(*args)
+        return run
+
+    def lap(self, name):
+        """
+        Adds the time since the previous lap, or start(), to phase name. Times the steps of a sequential
+        run without wrapping each in a with block.
+        """
+        now = time.perf_counter()
+        self.add_time(name, now - self.last_lap)
+        self.last_lap = now
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        report = OrderedDict()
+        report["algorithm"] = self.name
+        report["seconds"] = self.seconds
+        report["settings"] = dict(self.settings)
+        report["phases"] = dict(self.phases)
+        report["counters"] = dict(self.counters)
+        
+        # Throughput of the counters over the whole run
+        if self.seconds:
+            report["rates"] = {i: value / self.seconds for i, value in self.counters.items()}
+        if self.sampler is not None:
+            report["profile"] = self.sampler.report()
+        return report
+
+    def summary(self):
+        """
+        One line per phase and counter, for a log.
+        """
+        lines = ["{0}: {1:.3f}s".format(i, seconds) for i, seconds in self.phases.items()]
+        lines += ["{0}: {1}".format(i, value) for i, value in self.counters.items()]
+        return lines
+
+    def write(self, path):
+        with open(path, "w") as handle:
+            json.dump(self.as_dict(), handle, indent = 2, default = str)
+            handle.write("\n")
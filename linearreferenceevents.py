@@ -10,7 +10,10 @@
 *                                                                         *
 ***************************************************************************
 """
-from math import sqrt
+import os
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import QVariant
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
@@ -23,56 +26,130 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterMultipleLayers,
                        QgsProcessingParameterNumber,
                        QgsProcessingParameterBoolean,
-                       QgsProcessingUtils,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFileDestination,
                        QgsFields,
                        QgsField,
                        QgsWkbTypes,
                        QgsUnitTypes,
                        QgsFeature,
+                       QgsFeatureRequest,
                        QgsGeometry,
                        QgsMultiPoint,
+                       QgsLineString,
                        QgsPoint,
-                       QgsPointXY)
-import processing
+                       QgsVectorLayerFeatureSource)
 
+# Geometry core shared with the other klaw-processing scripts, it sits next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from geomcore import (project_events,
+                      distance_fancy_str,
+                      alignment_key,
+                      build_alignment,
+                      cached_alignment,
+                      event_fingerprints,
+                      extend_range,
+                      consolidate_record,
+                      cut_ranges,
+                      ordered_map,
+                      CHUNK_EVENTS,
+                      WRITE_BATCH,
+                      Metrics,
+                      Progress,
+                      np)
 
-def measure_along_line(line_vertices, vertex_idx_before, point_on_line):
+def route_coordinates(routes):
     """
+    (route_id, xs, ys) of (route_id, geometry) pairs, the form build_alignment takes.
     """
-    distance = 0
+    for route_id, geometry in routes:
+        route_vertices = [i for i in geometry.constGet().vertices()]
+        yield route_id, [i.x() for i in route_vertices], [i.y() for i in route_vertices]
+        continue
 
-    # Handles all vertices PRIOR to vertex before point_on_line. Reduction of one is to handle lookahead process. At loop termination, the v2 value will have the vertex before the point.
-    vertex_idx = 0
-    while vertex_idx < vertex_idx_before - 1:
-        v1 = line_vertices[vertex_idx]
-        v2 = line_vertices[vertex_idx + 1]
+def event_points(features, event_idx, comment_idx):
+    """
+    Yields (x, y, GUID, comment) for every vertex of every part of the event features. Does the work of
+    native:multiparttosingleparts and native:extractvertices without building intermediate layers.
+    """
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry.isNull():
+            continue
         
-        vxd = v1.x() - v2.x()
-        vyd = v1.y() - v2.y()
+        attributes = feature.attributes()
+        eid = attributes[event_idx] if event_idx > -1 else "-"
+        comment = attributes[comment_idx] if comment_idx > -1 else ""
         
-        distance += sqrt(vxd ** 2 + vyd ** 2)
-        vertex_idx += 1
+        for vertex in geometry.constGet().vertices():
+            yield vertex.x(), vertex.y(), eid, comment
         continue
+
+def read_events(event_source, event_fields):
+    """
+    Gathers (xs, ys, GUIDs, comments) of every event vertex in a feature source. Safe to run on a worker
+    thread as long as the source is a snapshot that no other thread reads.
+    """
+    event_idx = event_fields.indexOf("GUID")
+    comment_idx = event_fields.indexOf("comment")
+    events = event_source.getFeatures(QgsFeatureRequest().setSubsetOfAttributes([i for i in (event_idx, comment_idx) if i > -1]))
     
-    # Use case if measure is between vertices 0 & 1 (first segment)
-    if vertex_idx_before < 2:
-        v2 = line_vertices[0]
+    event_xs = array("d")
+    event_ys = array("d")
+    event_ids = []
+    event_comments = []
     
-    #Final distance addition from last vertex before point_on_line to point_on_line
-    vxd = v2.x() - point_on_line.x()
-    vyd = v2.y() - point_on_line.y()
-    distance += sqrt(vxd ** 2 + vyd ** 2)
+    for ex, ey, eid, comment in event_points(events, event_idx, comment_idx):
+        event_xs.append(ex)
+        event_ys.append(ey)
+        event_ids.append(eid)
+        event_comments.append(comment)
+        continue
     
-    return distance
+    return event_xs, event_ys, event_ids, event_comments
+
+def unchanged_records(previous_features, previous_fields, output_fields, fingerprints):
+    """
+    Yields the records of a previous output whose event id still has the same fingerprint, copied onto
+    output_fields by field name. Records of new, changed or deleted ids and "-" records are left out.
+    """
+    eid_idx = previous_fields.indexOf("event_id")
+    hash_idx = previous_fields.indexOf("event_hash")
+    field_idxs = [previous_fields.indexOf(i.name()) for i in output_fields]
+    
+    for feature in previous_features:
+        attributes = feature.attributes()
+        fingerprint = fingerprints.get(str(attributes[eid_idx]))
+        if fingerprint is None or fingerprint != attributes[hash_idx]:
+            continue
+        
+        record = QgsFeature(output_fields)
+        record.setAttributes([attributes[i] if i > -1 else None for i in field_idxs])
+        record.setGeometry(feature.geometry())
+        yield record
+        continue
+
+def consolidated_records(groups):
+    """
+    Surviving records of consolidate_record in fid order. Single records stay Unitary, otherwise the
+    minimum and maximum measure are tagged Start and End and the middle records are dropped.
+    """
+    survivors = []
+    for count, min_record, min_distance, max_record, max_distance in groups.values():
+        if count == 1:
+            survivors.append(min_record)
+            continue
+        
+        min_record.setAttribute(10, "Start")
+        max_record.setAttribute(10, "End")
+        survivors.append(min_record)
+        survivors.append(max_record)
+        continue
     
-def distance_fancy_str(distance, unit, modulo = 100):
-    first = int(distance / modulo)
-    second = round(distance % modulo)
-    return f"{first}+{second}"
+    survivors.sort(key = lambda i: i.attribute(0))
+    return survivors
 
-def min_max_sort(feature):
-    distance_on_line = feature.attributes()[5]
-    return distance_on_line
 
 
 class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
@@ -93,9 +170,16 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     EVENTS = 'EVENTS'
+    ROUTE_FIELD = 'ROUTE_FIELD'
     EPSILON = 'EPSILON'
     CONSOLIDATE = 'CONSOLIDATE'
+    WORKERS = 'WORKERS'
+    CACHE_DIR = 'CACHE_DIR'
+    PREVIOUS = 'PREVIOUS'
     OUTPUT = 'OUTPUT'
+    LINEAR_OUTPUT = 'LINEAR_OUTPUT'
+    PROFILE = 'PROFILE'
+    METRICS = 'METRICS'
 
     def tr(self, string):
         """
@@ -148,9 +232,6 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         """
         return self.tr("Example algorithm short description")
 
-    def flags(self):
-        return QgsProcessingAlgorithm.FlagNoThreading
-
     def initAlgorithm(self, config=None):
         """
         Here we define the inputs and output of the algorithm, along
@@ -167,6 +248,16 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
             )
         )
         
+        # Route network mode, many singlepart alignments told apart by this field
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ROUTE_FIELD,
+                self.tr('Route ID Field'),
+                parentLayerParameterName = self.INPUT,
+                optional = True
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.EPSILON,
@@ -190,6 +281,36 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
                 self.tr("Event Points")
             )
         )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr("Worker Threads (0 = All Cores)"),
+                QgsProcessingParameterNumber.Integer,
+                1,
+                minValue = 0
+            )
+        )
+        
+        # Preprocessed alignments are kept in memory between runs, this also keeps them on disk
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.CACHE_DIR,
+                self.tr("Alignment Cache Folder"),
+                behavior = QgsProcessingParameterFile.Folder,
+                optional = True
+            )
+        )
+
+        # Incremental mode, ids whose events are unchanged since this earlier output are copied instead of projected
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PREVIOUS,
+                self.tr('Previous Output Record Table'),
+                [QgsProcessing.TypeVector],
+                optional = True
+            )
+        )
 
         # We add a feature sink in which to store our processed features (this
         # usually takes the form of a newly created vector layer when the
@@ -200,10 +321,91 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
                 self.tr('Output Record Table')
             )
         )
+        
+        # Dynamic segmentation, the alignment substring between the lowest and highest measure of each event id
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.LINEAR_OUTPUT,
+                self.tr('Output Linear Events'),
+                QgsProcessing.TypeVectorLine,
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        # Diagnostics, a sampling profile of the processing and worker threads goes into the metrics
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PROFILE,
+                self.tr("Profile Run"),
+                False
+            )
+        )
+        
+        # Phase timers and counters of the run as JSON
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.METRICS,
+                self.tr('Output Metrics'),
+                self.tr('JSON files (*.json)'),
+                optional = True,
+                createByDefault = False
+            )
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        """
+        Runs on the main thread. Event layers belong to it, so everything processAlgorithm needs from
+        them is read here and their features are snapshotted into sources the worker threads can own.
+        """
+        event_layers = self.parameterAsLayerList(
+            parameters,
+            self.EVENTS,
+            context
+        )
+        
+        if event_layers is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.EVENTS))
+        
+        self.event_sources = []
+        for event_layer in event_layers:
+            self.event_sources.append((
+                event_layer.name(),
+                event_layer.featureCount(),
+                event_layer.sourceCrs(),
+                event_layer.fields(),
+                QgsVectorLayerFeatureSource(event_layer)
+            ))
+            continue
+        
+        return True
 
     def processAlgorithm(self, parameters, context, feedback):
         """
-        Here is where the processing itself takes place.
+        Here is where the processing itself takes place. The run is timed and counted, the metrics reach
+        the log and, when asked for, a JSON file.
+        """
+        metrics = Metrics(self.name(), self.parameterAsBool(parameters, self.PROFILE, context))
+        metrics_path = self.parameterAsFileOutput(parameters, self.METRICS, context)
+        
+        metrics.start()
+        try:
+            results = self.process_events(parameters, context, feedback, metrics)
+        finally:
+            metrics.stop()
+        
+        for line in metrics.summary():
+            feedback.pushDebugInfo(line)
+        
+        if metrics_path:
+            metrics.write(metrics_path)
+            results[self.METRICS] = metrics_path
+        
+        return results
+
+    def process_events(self, parameters, context, feedback, metrics):
+        """
+        Projects every event layer onto the alignment, timing each phase into metrics.
         """
 
         # Retrieve the feature source and sink. The 'dest_id' variable is used
@@ -225,8 +427,14 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         
         feedback.pushInfo('CRS is {0}, Units are {1}'.format(alignment_crs.authid(), alignment_units))
         
-        if alignment_count != 1:
-            raise QgsProcessingException("Alignment has more than one feature. Only one singlepart feature is allowed.")
+        route_field = self.parameterAsString(
+            parameters,
+            self.ROUTE_FIELD,
+            context
+        )
+        
+        if alignment_count != 1 and not route_field:
+            raise QgsProcessingException("Alignment has more than one feature. Only one singlepart feature is allowed unless a Route ID Field is set.")
         if QgsWkbTypes.isMultiType(alignment_wkb):
             raise QgsProcessingException("Alignment has multipart geometry. Convert LAYER to single parts.")
         if alignment_crs.isGeographic():
@@ -234,10 +442,46 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         if alignment_units != "feet":
             raise QgsProcessingException("Alignment has projection in other units than feet. Convert to planar system with units in feet.")
         
-        alignment_feature = alignment.getFeatures().__next__()
-        alignment_geometry = alignment_feature.geometry()
-        alignment_shape = alignment_geometry.get()
-        alignment_vertices = [i for i in alignment_shape.vertices()]
+        cache_dir = self.parameterAsFile(
+            parameters,
+            self.CACHE_DIR,
+            context
+        )
+        
+        if cache_dir and np is None:
+            feedback.pushInfo("NumPy is not available, Alignment Cache Folder is ignored")
+        
+        alignment_request = QgsFeatureRequest()
+        if route_field:
+            alignment_request.setSubsetOfAttributes([route_field], alignment.fields())
+        
+        routes = []
+        for alignment_feature in alignment.getFeatures(alignment_request):
+            alignment_geometry = alignment_feature.geometry()
+            if alignment_geometry.isNull():
+                continue
+            
+            routes.append((alignment_feature.attribute(route_field) if route_field else None, alignment_geometry))
+            continue
+        
+        metrics.lap("read_alignment")
+        
+        # Segment grid replaces the linear scan of QgsLineString.closestSegment, epsilon bounds the search.
+        # With a route network the same query assigns each event to its nearest route. Runs against an
+        # alignment seen before reuse its vertices, chainage and grid
+        alignment_hash = alignment_key(alignment_crs.toWkt(), route_field, [(i[0], bytes(i[1].asWkb())) for i in routes])
+        alignment_entry, alignment_origin = cached_alignment(alignment_hash, lambda: build_alignment(route_coordinates(routes)), cache_dir)
+        if alignment_entry is None:
+            raise QgsProcessingException("Alignment has no line with at least two vertices.")
+        
+        route_ids, alignment_chainages, segment_index = alignment_entry
+        feedback.pushInfo('Alignment preprocessing: {0}'.format(alignment_origin))
+        metrics.lap("preprocess")
+        metrics.settings["alignment"] = alignment_origin
+        metrics.settings["vertices"] = len(segment_index.xs)
+        
+        if route_field:
+            feedback.pushInfo('Route network of {0} alignments'.format(len(route_ids)))
         
         epsilon = self.parameterAsDouble(
             parameters,
@@ -251,27 +495,23 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
             context
         )
         
-        event_layers = self.parameterAsLayerList(
+        workers = self.parameterAsInt(
             parameters,
-            self.EVENTS,
+            self.WORKERS,
             context
         )
         
-        if event_layers is None:
-            raise QgsProcessingException(self.invalidSourceError(parameters, self.EVENTS))
+        if workers < 1:
+            workers = os.cpu_count() or 1
         
-        total_event_features = 0
-        mod_event_layers = []
+        metrics.settings["epsilon"] = epsilon
+        metrics.settings["consolidate"] = consolidate
+        metrics.settings["workers"] = workers
+        metrics.settings["numpy"] = np is not None
         
-        for event_layer in event_layers:
-            event_name = event_layer.name()
-            event_count = event_layer.featureCount()
-            event_wkb = event_layer.wkbType()
-            event_geom = QgsWkbTypes.geometryType(event_wkb)
-            event_multi = QgsWkbTypes.isMultiType(event_wkb)
-            event_crs = event_layer.sourceCrs()
-            event_units = QgsUnitTypes.toString(event_crs.mapUnits())
-            
+        mod_event_sources = []
+        
+        for event_name, event_count, event_crs, event_fields, event_source in self.event_sources:
             if event_count < 1:
                 feedback.pushInfo("Event Layer {0} is empty. Skipping...".format(event_name))
                 continue
@@ -279,28 +519,7 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
             if event_crs != alignment_crs:
                 raise QgsProcessingException("Alignment CRS mismatch with Event Layer {0} CRS!".format(event_name))
             
-            if event_multi:
-                event_layer = processing.run("native:multiparttosingleparts", {
-                    "INPUT": event_layer,
-                    "OUTPUT": "memory:"
-                }, context = context, feedback = feedback)["OUTPUT"]
-            
-            if event_geom > 1:
-                if False:
-                    event_layer = processing.run("qgis:densifygeometriesgivenaninterval", {
-                        "INPUT": event_layer,
-                        "INTERVAL": 10,
-                        "OUTPUT": "memory:"
-                    }, context = context, feedback = feedback)["OUTPUT"]
-                
-                event_layer = processing.run("native:extractvertices", {
-                    "INPUT": event_layer,
-                    "OUTPUT": "memory:"
-                }, context = context, feedback = feedback)["OUTPUT"]
-            
-            event_layer.setName(event_name)
-            total_event_features += event_count
-            mod_event_layers.append(event_layer)
+            mod_event_sources.append((event_name, event_fields, event_source))
             
             continue 
 
@@ -316,6 +535,20 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         OUTPUTFIELDS.append(QgsField("line_x", QVariant.Double, "double"))
         OUTPUTFIELDS.append(QgsField("line_y", QVariant.Double, "double"))
         OUTPUTFIELDS.append(QgsField("event_type", QVariant.String, "string", 255))
+        if route_field:
+            OUTPUTFIELDS.append(QgsField("route_id", QVariant.String, "string", 255))
+        OUTPUTFIELDS.append(QgsField("event_hash", QVariant.String, "string", 40))
+        hash_idx = OUTPUTFIELDS.indexOf("event_hash")
+        
+        previous = self.parameterAsSource(
+            parameters,
+            self.PREVIOUS,
+            context
+        )
+        
+        if previous is not None and previous.fields().indexOf("event_hash") == -1:
+            feedback.pushInfo("Previous Output Record Table has no event_hash field, every event is projected")
+            previous = None
         
         (sink, dest_id) = self.parameterAsSink(
             parameters,
@@ -329,129 +562,231 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         if sink is None:
             raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
         
+        LINEARFIELDS = QgsFields()
+        LINEARFIELDS.append(QgsField("event_id", QVariant.String, "string", 255))
+        if route_field:
+            LINEARFIELDS.append(QgsField("route_id", QVariant.String, "string", 255))
+        LINEARFIELDS.append(QgsField("from_measure", QVariant.Double, "double"))
+        LINEARFIELDS.append(QgsField("to_measure", QVariant.Double, "double"))
+        LINEARFIELDS.append(QgsField("from_str", QVariant.String, "string", 255))
+        LINEARFIELDS.append(QgsField("to_str", QVariant.String, "string", 255))
+        LINEARFIELDS.append(QgsField("length", QVariant.Double, "double"))
+        LINEARFIELDS.append(QgsField("event_hash", QVariant.String, "string", 40))
+        
+        (linear_sink, linear_dest_id) = self.parameterAsSink(
+            parameters,
+            self.LINEAR_OUTPUT,
+            context,
+            LINEARFIELDS,
+            QgsWkbTypes.LineString,
+            alignment_crs
+        )
+        
+        # Routes of copied records are known by their id only, the first route wins if an id repeats
+        route_positions = {}
+        for position, route_id in enumerate(route_ids):
+            route_positions.setdefault(str(route_id), position)
+            continue
+        
         feedback.setProgress(0)
+        metrics.lap("setup")
         
+        event_ranges = {}
         output_fid = 1
-        for event_layer in mod_event_layers:
-            # Stop the algorithm if cancel button has been clicked
-            if feedback.isCanceled():
-                break
-            
-            event_name = event_layer.name()
-            event_fields = event_layer.fields()
-            event_idx = event_fields.indexOf("GUID")
-            comment_idx = event_fields.indexOf("comment")
-            events = event_layer.getFeatures()
+        records_written = 0
+        consolidated = {}
+        feedback.pushDebugInfo("Workers: {0}, Chunk Size: {1}".format(workers, CHUNK_EVENTS))
+        
+        # A fingerprint covers everything that decides an id's records, these settings included
+        run_key = "{0}|{1}|{2}".format(alignment_hash, epsilon, consolidate)
+        
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            # Each layer is read on the pool from its own snapshot, then projected in chunks. Results come back
+            # in layer and chunk order and fids are handed out here, so they do not depend on the worker count
+            reads = [executor.submit(read_events, i[2], i[1]) for i in mod_event_sources]
             
-            for event in events:
-                egeom = event.geometry()
-                eshape = egeom.constGet()
-                epoint = QgsPointXY(eshape.x(), eshape.y())
-                epoint = QgsPoint(epoint)
+            read_layers = []
+            for (event_name, event_fields, event_source), read in zip(mod_event_sources, reads):
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
                 
-                if event_idx > -1:
-                    eid = event.attributes()[event_idx]
-                else:
-                    eid = "-"
+                read_layers.append((event_name,) + read.result())
+                continue
+            
+            for read in reads:
+                read.cancel()
+            
+            metrics.count("events_read", sum(len(i[1]) for i in read_layers))
+            metrics.lap("read_events")
+            
+            fingerprints = event_fingerprints(run_key, read_layers)
+            metrics.lap("fingerprint")
+            
+            # Incremental mode copies the records of unchanged ids, new records take fids after theirs
+            unchanged = set()
+            if previous is not None and not feedback.isCanceled():
+                batch = []
+                records_copied = 0
+                for record in unchanged_records(previous.getFeatures(), previous.fields(), OUTPUTFIELDS, fingerprints):
+                    unchanged.add(record.attribute(1))
+                    records_copied += 1
+                    output_fid = max(output_fid, record.attribute(0) + 1)
+                    batch.append(record)
                     
-                if comment_idx > -1:
-                    comment = event.attributes()[comment_idx]
-                else:
-                    comment = ""
-                
-                results = alignment_shape.closestSegment(eshape)
-                distance_away = sqrt(results[0])
-                point_on_line = results[1]
-                vertex_idx_after = results[2].vertex
-                side_of_line = results[3]
-                
-                if distance_away > epsilon and epsilon != -1:
+                    # Consolidated survivors still carry their id's lowest and highest measure
+                    if linear_sink is not None and record.attribute(1) != "-":
+                        route = route_positions.get(str(record.attribute(11))) if route_field else 0
+                        if route is not None:
+                            extend_range(event_ranges, (route, record.attribute(1)), record.attribute(5))
+                    
+                    if len(batch) >= WRITE_BATCH:
+                        sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                        batch = []
                     continue
                 
-                if side_of_line == -1:
-                    side_of_line = "Left"
-                elif side_of_line == 1:
-                    side_of_line = "Right"
-                else:
-                    side_of_line = "Unknown / On Line"
-                
-                distance_on_line = measure_along_line(alignment_vertices, vertex_idx_after - 1, point_on_line)
-                point_on_line = QgsPointXY(point_on_line.x(), point_on_line.y())
-                point_on_line = QgsPoint(point_on_line)
-                
-                record = QgsFeature()
-                record.setFields(OUTPUTFIELDS)
-                record.setAttribute(0, output_fid)
-                record.setAttribute(1, str(eid))
-                record.setAttribute(2, event_name)
-                record.setAttribute(3, comment)
-                record.setAttribute(4, distance_away)
-                record.setAttribute(5, distance_on_line)
-                record.setAttribute(6, distance_fancy_str(distance_on_line, alignment_units))
-                record.setAttribute(7, side_of_line)
-                record.setAttribute(8, point_on_line.x())
-                record.setAttribute(9, point_on_line.y())
-                record.setAttribute(10, "Unitary")
-                
-                if output_fid % 1000 == 0 and False:
-                    feedback.pushDebugInfo(str(repr(epoint) + "  " + repr(point_on_line)))
-                
-                
-                record_shape = QgsMultiPoint()
-                record_shape.addGeometry(epoint)
-                record_shape.addGeometry(point_on_line)
-                record_geometry = QgsGeometry(record_shape)
-                
-                record.setGeometry(record_geometry)
-                
-                if output_fid % 1000 == 0 and True:
-                    feedback.pushDebugInfo("Record Successfully Generated!")
-                
-                sink.addFeature(record)
-                
-                output_fid += 1
-                feedback.setProgress(int(output_fid / total_event_features))
+                sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                feedback.pushInfo("Incremental: {0} of {1} event ids unchanged".format(len(unchanged), len(fingerprints)))
+                metrics.count("ids_unchanged", len(unchanged))
+                metrics.count("records_copied", records_copied)
+            
+            metrics.lap("incremental")
+            
+            # Layers are cut down to their changed ids first, so progress runs over the events actually projected
+            project_layers = []
+            for event_name, event_xs, event_ys, event_ids, event_comments in read_layers:
+                if unchanged:
+                    keep = [i for i, eid in enumerate(event_ids) if str(eid) not in unchanged]
+                    event_xs = array("d", [event_xs[i] for i in keep])
+                    event_ys = array("d", [event_ys[i] for i in keep])
+                    event_ids = [event_ids[i] for i in keep]
+                    event_comments = [event_comments[i] for i in keep]
                 
+                project_layers.append((event_name, event_xs, event_ys, event_ids, event_comments))
                 continue
-            sink.flushBuffer()
-            continue
             
-        sink = QgsProcessingUtils.mapLayerFromString(dest_id, context)
-        
-        if consolidate:
-            output_unique = list(sink.uniqueValues(1))
-            for unique in output_unique:
-                if unique == "-":
-                    continue
+            progress = Progress(feedback.setProgress, sum(len(i[1]) for i in project_layers))
+            
+            for event_name, event_xs, event_ys, event_ids, event_comments in project_layers:
+                # Stop the algorithm if cancel button has been clicked
+                if feedback.isCanceled():
+                    break
                 
-                sink.selectByExpression(""""event_id" = '{0}'""".format(unique))
+                def project_chunk(chunk_start):
+                    chunk_end = chunk_start + CHUNK_EVENTS
+                    return project_events(segment_index, alignment_chainages, event_xs[chunk_start:chunk_end], event_ys[chunk_start:chunk_end], epsilon)
                 
-                unique_count = sink.selectedFeatureCount()
-                if unique_count == 1:
+                for chunk_start, projections in ordered_map(executor, metrics.timed("project_workers", project_chunk), range(0, len(event_xs), CHUNK_EVENTS), workers * 2):
+                    if feedback.isCanceled():
+                        break
+                    
+                    chunk_end = chunk_start + len(projections)
+                    metrics.count("events_projected", len(projections))
+                    # Farther than epsilon from the alignment
+                    metrics.count("events_filtered", projections.count(None))
+                    for ex, ey, eid, comment, projection in zip(event_xs[chunk_start:chunk_end], event_ys[chunk_start:chunk_end], event_ids[chunk_start:chunk_end], event_comments[chunk_start:chunk_end], projections):
+                        if projection is None:
+                            continue
+                        
+                        distance_away, distance_on_line, line_x, line_y, side_of_line, vertex_idx_after = projection
+                        route = segment_index.route_of(vertex_idx_after)
+                        route_id = route_ids[route]
+                        epoint = QgsPoint(ex, ey)
+                        point_on_line = QgsPoint(line_x, line_y)
+                        
+                        if side_of_line == -1:
+                            side_of_line = "Left"
+                        elif side_of_line == 1:
+                            side_of_line = "Right"
+                        else:
+                            side_of_line = "Unknown / On Line"
+                        
+                        record = QgsFeature()
+                        record.setFields(OUTPUTFIELDS)
+                        record.setAttribute(0, output_fid)
+                        record.setAttribute(1, str(eid))
+                        record.setAttribute(2, event_name)
+                        record.setAttribute(3, comment)
+                        record.setAttribute(4, distance_away)
+                        record.setAttribute(5, distance_on_line)
+                        record.setAttribute(6, distance_fancy_str(distance_on_line, alignment_units))
+                        record.setAttribute(7, side_of_line)
+                        record.setAttribute(8, point_on_line.x())
+                        record.setAttribute(9, point_on_line.y())
+                        record.setAttribute(10, "Unitary")
+                        if route_field:
+                            record.setAttribute(11, str(route_id))
+                        record.setAttribute(hash_idx, fingerprints.get(str(eid), ""))
+                        
+                        record_shape = QgsMultiPoint()
+                        record_shape.addGeometry(epoint)
+                        record_shape.addGeometry(point_on_line)
+                        record_geometry = QgsGeometry(record_shape)
+                        
+                        record.setGeometry(record_geometry)
+                        
+                        if linear_sink is not None and str(eid) != "-":
+                            extend_range(event_ranges, (route, str(eid)), distance_on_line)
+                        
+                        # Consolidated ids are held back until every layer is read, only their survivors reach the sink
+                        if consolidate and str(eid) != "-":
+                            consolidate_record(consolidated, (route_id, str(eid)), record, distance_on_line)
+                        else:
+                            sink.addFeature(record)
+                            records_written += 1
+                        
+                        output_fid += 1
+                        continue
+                    
+                    progress.advance(len(projections))
                     continue
+                sink.flushBuffer()
+                continue
+        
+        metrics.count("records_written", records_written)
+        metrics.lap("project")
+        
+        if consolidate:
+            survivors = consolidated_records(consolidated)
+            feedback.pushDebugInfo("Consolidated {0} event ids to {1} records".format(len(consolidated), len(survivors)))
+            sink.addFeatures(survivors, QgsFeatureSink.FastInsert)
+            sink.flushBuffer()
+            metrics.count("ids_consolidated", len(consolidated))
+            metrics.count("records_written", len(survivors))
+            metrics.lap("consolidate")
+        
+        if not feedback.isCanceled():
+            progress.finish()
+        
+        results = {self.OUTPUT: dest_id}
+        
+        if linear_sink is not None and not feedback.isCanceled():
+            # Zero length ranges, ids with a single record or all records at one measure, have no substring
+            keys = [i for i, span in event_ranges.items() if span[1] > span[0]]
+            spans = [(i[0], event_ranges[i][0], event_ranges[i][1]) for i in keys]
+            lines = cut_ranges(segment_index.xs, segment_index.ys, alignment_chainages, segment_index.route_starts, spans)
+            
+            batch = []
+            for (route, eid), (route, from_measure, to_measure), (line_xs, line_ys) in zip(keys, spans, lines):
+                linear_record = QgsFeature(LINEARFIELDS)
+                attributes = [eid]
+                if route_field:
+                    attributes.append(str(route_ids[route]))
+                attributes += [from_measure, to_measure, distance_fancy_str(from_measure, alignment_units), distance_fancy_str(to_measure, alignment_units), to_measure - from_measure, fingerprints.get(eid, "")]
+                linear_record.setAttributes(attributes)
+                linear_record.setGeometry(QgsGeometry(QgsLineString(line_xs, line_ys)))
+                batch.append(linear_record)
                 
-                sink.startEditing()
-                feedback.pushDebugInfo("Clearing middle points for {0}".format(unique))
-                
-                features = [i for i in sink.getSelectedFeatures()]
-                features.sort(key = min_max_sort)
-                min_fid = features[0].attributes()[0]
-                max_fid = features[-1].attributes()[0]
-                dispose_fids = [str(i.attributes()[0]) for i in features[1:-1]]
-                dispose_fids_sql = '(' + ",".join(dispose_fids) + ')'
-                
-                sink.removeSelection()
-                sink.selectByExpression(""""fid" IN {0}""".format(dispose_fids_sql))
-                count = sink.deleteSelectedFeatures()
-                sink.removeSelection()
-                
-                sink.changeAttributeValue(min_fid, 10, "Start")
-                sink.changeAttributeValue(max_fid, 10, "End")
-                
-                feedback.pushDebugInfo("Features deleted: {0}".format(str(count)))
-                sink.commitChanges()
-                
+                if len(batch) >= WRITE_BATCH:
+                    linear_sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                    batch = []
                 continue
+            
+            linear_sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+            feedback.pushInfo("Cut {0} linear events".format(len(keys)))
+            results[self.LINEAR_OUTPUT] = linear_dest_id
+            metrics.count("linear_events", len(keys))
+            metrics.lap("linear")
 
         # Return the results of the algorithm. In this case our only result is
         # the feature sink which contains the processed features, but some
@@ -459,4 +794,4 @@ class LinearReferenceEventsAlgorithm(QgsProcessingAlgorithm):
         # statistics, etc. These should all be included in the returned
         # dictionary, with keys matching the feature corresponding parameter
         # or output names.
-        return {self.OUTPUT: dest_id}
+        return results
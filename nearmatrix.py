@@ -1,16 +1,236 @@
 # Kristoffer Law
+import os
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import QVariant 
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
-from qgis.core import QgsProcessingParameterField
+from qgis.core import QgsProcessingParameterField, QgsProcessingParameterNumber, QgsProcessingParameterEnum, QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFileDestination, QgsProcessingParameterFolderDestination
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource
 from qgis.core import QgsProcessingFeatureSource
 from qgis.core import QgsVectorLayer, QgsVectorLayerFeatureSource
-from qgis.core import QgsFields, QgsField, QgsFeature, QgsWkbTypes
+from qgis.core import QgsFields, QgsField, QgsFeature, QgsFeatureSink, QgsWkbTypes
+from qgis.core import QgsSpatialIndex, QgsGeometry, QgsLineString, QgsFeatureRequest
 import processing
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Geometry core shared with the other klaw-processing scripts, it sits next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from geomcore import nearest_points, envelope_distances, bounded_nearest, ordered_map, Metrics, Progress, NearMatrixWriter
+from geomcore import BLOCK_CELLS, WRITE_BATCH
+
+
+# Most input features handed to a worker at a time
+CHUNK_SIZE = 256
+
+# OUTPUT_MODE options
+OUTPUT_MODES = ["Shortest lines", "Table (distance only)", "Binary matrix (NumPy folder)"]
+
+
+def load_near(source, field, points):
+    # Near layer reduced to its ID values plus coordinates (points) or bare geometries, no QgsFeature is kept
+    request = QgsFeatureRequest().setSubsetOfAttributes([field], source.fields())
+    ids = []
+    geometries = []
+    coordinates = array("d")
+    
+    for feature in source.getFeatures(request):
+        geometry = feature.geometry()
+        if geometry.isNull():
+            continue
+        
+        ids.append(feature.attribute(field))
+        if points:
+            point = geometry.constGet()
+            coordinates.append(point.x())
+            coordinates.append(point.y())
+        else:
+            geometries.append(geometry)
+        continue
+    
+    xy = np.array(coordinates).reshape(-1, 2) if points else None
+    return ids, geometries, xy
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+        continue
+    
+    if chunk:
+        yield chunk
+
+def near_pairs(input_shape, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance, with_lines):
+    # One geometric solve per pair. With lines the distance is the length of the shortest line,
+    # without them the input is prepared once and measured against the cached near shapes. Returns the
+    # kept pairs and the number of candidates measured
+    
+    engine = None
+    if not with_lines:
+        engine = QgsGeometry.createGeometryEngine(input_shape.constGet())
+        engine.prepareGeometry()
+    
+    # Envelope branch and bound. The index over near envelopes hands out the candidates and a pair is
+    # only solved when its envelope distance says it can still qualify. Index ids are positions in
+    # near_geometries
+    if near_boxes is not None:
+        solved = {}
+        
+        def exact(candidate_id):
+            # Cached, a doubled nearest query hands the same candidates back
+            if candidate_id not in solved:
+                if engine is not None:
+                    solved[candidate_id] = (engine.distance(near_shapes[candidate_id]), None)
+                else:
+                    line = input_shape.shortestLine(near_geometries[candidate_id])
+                    solved[candidate_id] = (line.length() if not line.isNull() else input_shape.distance(near_geometries[candidate_id]), line)
+            return solved[candidate_id][0]
+        
+        box = input_shape.boundingBox()
+        envelope = (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+        if k_nearest > 0:
+            # Nearest envelopes first, twice as many each round until the farthest one fetched is past the
+            # k-th best distance (or the limit), so nothing left in the index can qualify
+            wanted = k_nearest
+            while True:
+                candidate_ids = near_index.nearestNeighbor(input_shape, wanted, max(max_distance, 0))
+                bounds = envelope_distances(envelope, near_boxes[candidate_ids])
+                found, evaluated = bounded_nearest(candidate_ids, bounds, exact, k_nearest, max_distance)
+                if len(candidate_ids) < wanted or (len(found) == k_nearest and bounds.max() > found[-1][0]) or (max_distance != -1 and bounds.max() > max_distance):
+                    break
+                wanted *= 2
+                continue
+        else:
+            candidate_ids = near_index.intersects(box.buffered(max_distance))
+            found, evaluated = bounded_nearest(candidate_ids, envelope_distances(envelope, near_boxes[candidate_ids]), exact, 0, max_distance)
+        
+        return [(distance, i, solved[i][1]) for distance, i in found], len(solved)
+    
+    # Full matrix is every near geometry in layer order, indexed search only measures candidates.
+    # Index ids are positions in near_geometries
+    if near_index is None:
+        candidate_ids = range(len(near_geometries))
+    elif k_nearest > 0:
+        candidate_ids = near_index.nearestNeighbor(input_shape, k_nearest, max(max_distance, 0))
+    else:
+        candidate_ids = near_index.intersects(input_shape.boundingBox().buffered(max_distance))
+    
+    pairs = []
+    for candidate_id in candidate_ids:
+        if engine is not None:
+            line = None
+            distance = engine.distance(near_shapes[candidate_id])
+        else:
+            line = input_shape.shortestLine(near_geometries[candidate_id])
+            distance = line.length() if not line.isNull() else input_shape.distance(near_geometries[candidate_id])
+        
+        if distance > max_distance and max_distance != -1:
+            continue
+        
+        pairs.append((distance, candidate_id, line))
+        continue
+    
+    # nearestNeighbor may hand back extra ties, trim to k closest in a stable order
+    if near_index is not None:
+        pairs.sort(key = lambda i: (i[0], i[1]))
+        if k_nearest > 0:
+            pairs = pairs[:k_nearest]
+    
+    return pairs, len(candidate_ids)
+
+def near_rows(input_chunk, input_field, near_ids, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance, with_lines):
+    # Worker side, touches geometries only. Features are built on the calling thread. Also returns the
+    # number of exact distances evaluated
+    rows = []
+    evaluated = 0
+    for input_feature in input_chunk:
+        input_shape = input_feature.geometry()
+        if input_shape.isNull():
+            continue
+        
+        input_id = input_feature.attribute(input_field)
+        pairs, pair_count = near_pairs(input_shape, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance, with_lines)
+        evaluated += pair_count
+        for distance, near_idx, line in pairs:
+            rows.append((input_id, near_ids[near_idx], distance, line))
+            continue
+        continue
+    
+    return rows, evaluated
+
+def near_block(input_chunk, input_field, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance):
+    # Binary matrix form of near_rows, (input_ids, row positions, near positions, distances) of the chunk
+    # plus the number of exact distances evaluated. Rows without a geometry are left out
+    input_ids = []
+    rows = array("q")
+    near_positions = array("q")
+    distances = array("d")
+    evaluated = 0
+    for input_feature in input_chunk:
+        input_shape = input_feature.geometry()
+        if input_shape.isNull():
+            continue
+        
+        pairs, pair_count = near_pairs(input_shape, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance, False)
+        evaluated += pair_count
+        for distance, near_idx, line in pairs:
+            rows.append(len(input_ids))
+            near_positions.append(near_idx)
+            distances.append(distance)
+            continue
+        
+        input_ids.append(input_feature.attribute(input_field))
+        continue
+    
+    return (input_ids, np.frombuffer(rows, dtype = np.int64), np.frombuffer(near_positions, dtype = np.int64), np.frombuffer(distances)), evaluated
+
+def is_single_point(source):
+    wkb_type = source.wkbType()
+    return QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PointGeometry and not QgsWkbTypes.isMultiType(wkb_type)
+
+def point_chunk(features, field):
+    # ID values and (n, 2) coordinate array of a chunk of point features, null geometries dropped
+    ids = []
+    xy = np.empty((len(features), 2))
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry.isNull():
+            continue
+        
+        point = geometry.constGet()
+        xy[len(ids)] = (point.x(), point.y())
+        ids.append(feature.attribute(field))
+        continue
+    
+    return ids, xy[:len(ids)]
+
+def point_rows(input_ids, input_xy, near_ids, near_xy, k_nearest, max_distance, with_lines):
+    # One distance block of inputs x all near points. Row order matches the generic path: layer order for the
+    # full matrix, closest first (ties in layer order) as the indexed search sorts once a limit is set
+    keep_rows, keep_near, keep_distances = nearest_points(input_xy, near_xy, k_nearest, max_distance)
+    
+    rows = []
+    for input_idx, near_idx, distance in zip(keep_rows.tolist(), keep_near.tolist(), keep_distances.tolist()):
+        line = None
+        if with_lines:
+            line = QgsGeometry(QgsLineString([input_xy[input_idx, 0], near_xy[near_idx, 0]], [input_xy[input_idx, 1], near_xy[near_idx, 1]]))
+        rows.append((input_ids[input_idx], near_ids[near_idx], distance, line))
+        continue
+    
+    return rows, len(input_ids) * len(near_ids)
+
 
 class NearMatrixAlgorithm(QgsProcessingAlgorithm):
     
@@ -18,7 +238,14 @@ class NearMatrixAlgorithm(QgsProcessingAlgorithm):
     NEAR = "NEAR"
     INPUTFIELD = "INPUTFIELD"
     NEARFIELD = "NEARFIELD"
+    K_NEAREST = "K_NEAREST"
+    MAX_DISTANCE = "MAX_DISTANCE"
+    WORKERS = "WORKERS"
+    OUTPUT_MODE = "OUTPUT_MODE"
     OUTPUT = "OUTPUT"
+    MATRIX_OUTPUT = "MATRIX_OUTPUT"
+    PROFILE = "PROFILE"
+    METRICS = "METRICS"
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -33,11 +260,52 @@ class NearMatrixAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterField(self.NEARFIELD, 'Near Field', type=QgsProcessingParameterField.Any, parentLayerParameterName=self.NEAR)
         )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.K_NEAREST, 'Nearest Count (0 = All)', type=QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.MAX_DISTANCE, 'Maximum Distance (-1 = No Limit)', type=QgsProcessingParameterNumber.Double, defaultValue=-1, minValue=-1)
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(self.WORKERS, 'Worker Threads (0 = All Cores)', type=QgsProcessingParameterNumber.Integer, defaultValue=1, minValue=0)
+        )
+        self.addParameter(
+            QgsProcessingParameterEnum(self.OUTPUT_MODE, 'Output Mode', options=OUTPUT_MODES, defaultValue=0)
+        )
         self.addParameter(
             QgsProcessingParameterFeatureSink(self.OUTPUT, 'Near Matrix', type=QgsProcessing.TypeFile)
         )
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(self.MATRIX_OUTPUT, 'Binary Matrix Folder', optional=True, createByDefault=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(self.PROFILE, 'Profile Run', defaultValue=False)
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(self.METRICS, 'Output Metrics', 'JSON files (*.json)', optional=True, createByDefault=False)
+        )
 
     def processAlgorithm(self, parameters, context, feedback):
+        # Timers and counters of the run go to the log, and to a JSON file when one is given
+        metrics = Metrics(self.name(), self.parameterAsBool(parameters, self.PROFILE, context))
+        metrics_path = self.parameterAsFileOutput(parameters, self.METRICS, context)
+        
+        metrics.start()
+        try:
+            results = self.process_matrix(parameters, context, feedback, metrics)
+        finally:
+            metrics.stop()
+        
+        for line in metrics.summary():
+            feedback.pushDebugInfo(line)
+        
+        if metrics_path:
+            metrics.write(metrics_path)
+            results[self.METRICS] = metrics_path
+        
+        return results
+
+    def process_matrix(self, parameters, context, feedback, metrics):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
         feedback = QgsProcessingMultiStepFeedback(1, feedback)
@@ -48,6 +316,22 @@ class NearMatrixAlgorithm(QgsProcessingAlgorithm):
         input_field = self.parameterAsString(parameters, self.INPUTFIELD, context)
         near = self.parameterAsSource(parameters, self.NEAR, context)
         near_field = self.parameterAsString(parameters, self.NEARFIELD, context)
+        k_nearest = self.parameterAsInt(parameters, self.K_NEAREST, context)
+        max_distance = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        output_mode = self.parameterAsEnum(parameters, self.OUTPUT_MODE, context)
+        with_lines = output_mode == 0
+        binary = output_mode == 2
+        
+        if workers < 1:
+            workers = os.cpu_count() or 1
+        
+        # Binary mode leaves the Near Matrix table empty and writes .npy arrays to the folder instead
+        matrix_folder = self.parameterAsFileOutput(parameters, self.MATRIX_OUTPUT, context) if binary else ""
+        if binary and np is None:
+            raise QgsProcessingException("Binary matrix output needs NumPy")
+        if binary and not matrix_folder:
+            raise QgsProcessingException("Binary matrix output needs a Binary Matrix Folder")
         
         if input.sourceCrs() != near.sourceCrs():
             result = processing.run("native:reprojectlayer", {"INPUT": parameters[self.NEAR], "TARGET_CRS": input.sourceCrs(), "OUTPUT": "memory:"}, context = context, feedback = feedback, is_child_algorithm = True)
@@ -63,46 +347,130 @@ class NearMatrixAlgorithm(QgsProcessingAlgorithm):
         output_fields.append(near_out_field)
         output_fields.append(QgsField("distance", QVariant.Double, "double"))
         
-        output_geom_type = QgsWkbTypes.LineString
+        # Table mode writes (input_id, near_id, distance) rows only, no line is ever built
+        output_geom_type = QgsWkbTypes.LineString if with_lines else QgsWkbTypes.NoGeometry
+        
+        output, dest_id = self.parameterAsSink(parameters, self.OUTPUT, context, output_fields, output_geom_type, input.sourceCrs())
+        results[self.OUTPUT] = dest_id
         
-        output = self.parameterAsSink(parameters, "output", context, output_fields, output_geom_type, input.sourceCrs())[0]
+        metrics.lap("setup")
         
-        input_features = [i for i in input.getFeatures()]
-        near_features = [i for i in near.getFeatures()]
+        # Inputs are streamed with only the ID field fetched, the near side is cached once as IDs and geometry
+        input_request = QgsFeatureRequest().setSubsetOfAttributes([input_field], input.fields())
+        point_mode = np is not None and is_single_point(input) and is_single_point(near)
+        near_ids, near_geometries, near_xy = load_near(near, near_field, point_mode)
+        metrics.lap("load_near")
         
-        input_idx = 0
-        input_count = len(input_features)
-        near_count = len(near_features)
+        input_count = max(input.featureCount(), 1)
+        near_count = len(near_ids)
         
         feedback.pushDebugInfo(f"Input Count: {input_count}, Near Count: {near_count}")
+        metrics.settings.update(k_nearest=k_nearest, max_distance=max_distance, workers=workers, lines=with_lines, point_mode=point_mode, near_count=near_count)
         
-        for input_feature in input_features:
-            input_id = input_feature.attribute(input_field)
-            input_shape = input_feature.geometry()
+        # Point to point layers skip GEOS entirely and measure blocks of pairs with NumPy
+        if point_mode:
+            block_rows = max(1, min(CHUNK_SIZE * 16, BLOCK_CELLS // max(near_count, 1)))
+            
+            def compute(chunk):
+                input_ids, input_xy = point_chunk(chunk, input_field)
+                if binary:
+                    return (input_ids,) + nearest_points(input_xy, near_xy, k_nearest, max_distance), len(input_ids) * near_count
+                return point_rows(input_ids, input_xy, near_ids, near_xy, k_nearest, max_distance, with_lines)
+            
+            chunks = chunked(input.getFeatures(input_request), block_rows)
+            feedback.pushDebugInfo(f"Point fast path, Workers: {workers}, Block Rows: {block_rows}")
+        else:
+            # Default is the full matrix. A count or distance limit switches to a spatial index over the near layer,
+            # with NumPy an index of envelopes alone whose candidates are pruned by envelope distance
+            near_index = None
+            near_boxes = None
+            if (k_nearest > 0 or max_distance != -1) and np is not None:
+                near_index = QgsSpatialIndex()
+                near_boxes = np.empty((len(near_geometries), 4))
+                for near_idx, near_geometry in enumerate(near_geometries):
+                    box = near_geometry.boundingBox()
+                    near_boxes[near_idx] = (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+                    near_index.addFeature(near_idx, box)
+                    continue
+                feedback.pushDebugInfo(f"Envelope branch and bound, K Nearest: {k_nearest}, Max Distance: {max_distance}")
+            elif k_nearest > 0 or max_distance != -1:
+                near_index = QgsSpatialIndex(QgsSpatialIndex.FlagStoreFeatureGeometries)
+                for near_idx, near_geometry in enumerate(near_geometries):
+                    near_feature = QgsFeature(near_idx)
+                    near_feature.setGeometry(near_geometry)
+                    near_index.addFeature(near_feature)
+                    continue
+                feedback.pushDebugInfo(f"Indexed search, K Nearest: {k_nearest}, Max Distance: {max_distance}")
+            metrics.lap("index")
+            
+            # Abstract shapes are taken once here rather than per outer iteration
+            near_shapes = [i.constGet() for i in near_geometries]
+            
+            def compute(chunk):
+                if binary:
+                    return near_block(chunk, input_field, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance)
+                return near_rows(chunk, input_field, near_ids, near_geometries, near_shapes, near_index, near_boxes, k_nearest, max_distance, with_lines)
             
-            for near_feature in near_features:
-                near_id = near_feature.attribute(near_field)
-                near_shape = near_feature.geometry()
-                distance = input_shape.distance(near_shape)
-                line = input_shape.shortestLine(near_shape)
+            chunk_rows = max(1, min(CHUNK_SIZE, BLOCK_CELLS // max(k_nearest or near_count, 1)))
+            chunks = chunked(input.getFeatures(input_request), chunk_rows)
+            feedback.pushDebugInfo(f"Workers: {workers}, Chunk Size: {chunk_rows}")
+        
+        # Chunks are computed on the pool and merged back in input order, so output is identical for any worker count.
+        # Worker seconds add up across threads, the wall time of the loop is the write phase
+        progress = Progress(feedback.setProgress, input_count)
+        rows_written = 0
+        
+        # A matrix without a count or distance limit is stored dense, anything cut by one as csr
+        matrix = None
+        if binary:
+            matrix = NearMatrixWriter(matrix_folder, near_ids, k_nearest == 0 and max_distance == -1, {"k_nearest": k_nearest, "max_distance": max_distance})
+            results[self.MATRIX_OUTPUT] = matrix_folder
+        
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for chunk, (rows, evaluated) in ordered_map(executor, metrics.timed("compute_workers", compute), chunks, workers * 2):
+                chunk_size = len(chunk)
+                metrics.count("inputs", chunk_size)
+                metrics.count("pairs_evaluated", evaluated)
+                metrics.count("pairs_total", chunk_size * near_count)
                 
-                result = QgsFeature()
-                result.setFields(output_fields)
-                result.setAttribute(0, input_id)
-                result.setAttribute(1, near_id)
-                result.setAttribute(2, distance)
-                result.setGeometry(line)
-                output.addFeature(result)
+                if matrix is not None:
+                    matrix.add_rows(*rows)
+                    rows_written += len(rows[1])
+                    progress.advance(chunk_size)
+                    if feedback.isCanceled():
+                        break
+                    continue
                 
-                continue 
+                rows_written += len(rows)
+                batch = []
+                for input_id, near_id, distance, line in rows:
+                    result = QgsFeature(output_fields)
+                    result.setAttributes([input_id, near_id, distance])
+                    if line is not None:
+                        result.setGeometry(line)
+                    batch.append(result)
+                    
+                    if len(batch) >= WRITE_BATCH:
+                        output.addFeatures(batch, QgsFeatureSink.FastInsert)
+                        batch = []
+                    continue 
                 
-            input_idx += 1
-            progress = (input_idx / input_count) * 100
-            feedback.setProgress(progress)
-            
-            if feedback.isCanceled():
-                break
-            continue 
+                output.addFeatures(batch, QgsFeatureSink.FastInsert)
+                progress.advance(chunk_size)
+                
+                if feedback.isCanceled():
+                    break
+                continue 
+        
+        if matrix is not None:
+            matrix.close()
+            feedback.pushInfo(f"Binary matrix: {'dense' if matrix.dense else 'csr'}, {len(matrix.input_ids)} x {near_count}, {rows_written} pairs")
+        
+        metrics.count("rows_written", rows_written)
+        metrics.lap("compute_write")
+        feedback.pushInfo(f"Exact distances evaluated: {metrics.counters.get('pairs_evaluated', 0)} of {metrics.counters.get('pairs_total', 0)} pairs")
+        if not feedback.isCanceled():
+            progress.finish()
 
         return results
 
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checks of the command line runner: event consolidation against the sort based pass it replaced, and the
+readers and writers round tripping GeoPackage, CSV and Parquet files.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import csv
+import random
+import sqlite3
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batchrun
+from batchrun import (event_records,
+                      input_paths,
+                      main,
+                      read_features,
+                      wkb_parts,
+                      wkt_parts,
+                      CsvWriter,
+                      GpkgWriter,
+                      ParquetWriter)
+from geomcore import build_alignment, np
+
+FIELDS = [("fid", "int"), ("name", "text"), ("value", "float")]
+
+
+def sorted_consolidation(records):
+    """
+    Reference of the old selectByExpression pass over (fid, route_id, event_id, measure) records in fid
+    order: per route and id a stable sort by measure, the first record Start and the last End. Returns
+    {fid: event_type} of the surviving records.
+    """
+    groups = {}
+    survivors = {}
+    for fid, route_id, event_id, measure in records:
+        if event_id == "-":
+            survivors[fid] = "Unitary"
+        else:
+            groups.setdefault((route_id, event_id), []).append((measure, fid))
+        continue
+
+    for group in groups.values():
+        if len(group) == 1:
+            survivors[group[0][1]] = "Unitary"
+            continue
+
+        group.sort(key = lambda i: i[0])
+        survivors[group[0][1]] = "Start"
+        survivors[group[-1][1]] = "End"
+        continue
+    return survivors
+
+def test_event_records_consolidation_matches_sort():
+    rng = random.Random(9)
+    route_ids, chainages, segment_index = build_alignment([("A", [0.0, 10.0], [0.0, 0.0]), ("B", [0.0, 10.0], [5.0, 5.0])])
+    route_afters = {"A": 1, "B": 3}
+
+    for trial in range(50):
+        count = rng.randrange(1, 300)
+        chunk = rng.randrange(1, 40)
+        # Few ids and whole number measures, so most groups hold ties at both ends
+        event_ids = [rng.choice(["-", "a", "b", "c", "d"]) for _ in range(count)]
+        projections = []
+        records = []
+        for event_id in event_ids:
+            if rng.random() < 0.1:
+                projections.append(None)
+                continue
+
+            route_id = rng.choice("AB")
+            measure = float(rng.randrange(4))
+            projections.append((1.0, measure, measure, 0.0, -1, route_afters[route_id]))
+            records.append((len(records) + 1, route_id, event_id, measure))
+            continue
+
+        projected = [(start, projections[start:start + chunk]) for start in range(0, count, chunk)]
+        rows = [row for block in event_records("e", [0.0] * count, [0.0] * count, event_ids, [""] * count, projected, route_ids, segment_index, True, True) for row in block]
+        expected = sorted_consolidation(records)
+
+        assert {row[0]: row[10] for row in rows} == expected
+        assert len(rows) == len(expected)
+        # Unconsolidated rows come with their chunk, the survivors last in fid order
+        survivors = [row[0] for row in rows if row[1] != "-"]
+        assert survivors == sorted(survivors)
+        assert [row[0] for row in rows if row[1] == "-"] == [i[0] for i in records if i[2] == "-"]
+        continue
+
+def test_event_records_without_consolidation():
+    route_ids, chainages, segment_index = build_alignment([("A", [0.0, 10.0], [0.0, 0.0])])
+    projections = [(1.0, 2.0, 2.0, 0.0, 1, 1), None, (1.0, 2.0, 2.0, 0.0, 0, 1)]
+    rows = [row for block in event_records("e", [0.0] * 3, [0.0] * 3, ["a"] * 3, ["x"] * 3, [(0, projections)], route_ids, segment_index, False, False) for row in block]
+
+    assert [(row[0], row[7], row[10]) for row in rows] == [(1, "Right", "Unitary"), (2, "Unknown / On Line", "Unitary")]
+    assert rows[0][-1] == ([0.0, 2.0], [0.0, 0.0])
+
+def test_wkb_parts():
+    point = struct.pack("<BIdd", 1, 1, 1.5, 2.5)
+    assert wkb_parts(point) == ([([1.5], [2.5])], len(point))
+    # Empty point, NaN ordinates
+    assert wkb_parts(struct.pack("<BIdd", 1, 1, float("nan"), float("nan")))[0] == []
+
+    # Big endian line, ISO Z line and EWKB line with an SRID and Z and M flags, extra ordinates dropped
+    line = struct.pack(">BII4d", 0, 2, 2, 0.0, 1.0, 2.0, 3.0)
+    assert wkb_parts(line)[0] == [([0.0, 2.0], [1.0, 3.0])]
+    line_z = struct.pack("<BII6d", 1, 1002, 2, 0.0, 1.0, 9.0, 2.0, 3.0, 9.0)
+    assert wkb_parts(line_z)[0] == [([0.0, 2.0], [1.0, 3.0])]
+    line_zm = struct.pack("<BIiI8d", 1, 0x20000002 | 0x80000000 | 0x40000000, 2263, 2, 0.0, 1.0, 9.0, 8.0, 2.0, 3.0, 9.0, 8.0)
+    assert wkb_parts(line_zm)[0] == [([0.0, 2.0], [1.0, 3.0])]
+
+    polygon = struct.pack("<BIII8dI8d", 1, 3, 2, 4, 0.0, 0.0, 4.0, 0.0, 4.0, 4.0, 0.0, 0.0, 4, 1.0, 1.0, 2.0, 1.0, 2.0, 2.0, 1.0, 1.0)
+    assert wkb_parts(polygon)[0] == [([0.0, 4.0, 4.0, 0.0], [0.0, 0.0, 4.0, 0.0]), ([1.0, 2.0, 2.0, 1.0], [1.0, 1.0, 2.0, 1.0])]
+    multi = struct.pack("<BII", 1, 4, 2) + point + struct.pack("<BIdd", 1, 1, 3.0, 4.0)
+    assert wkb_parts(multi) == ([([1.5], [2.5]), ([3.0], [4.0])], len(multi))
+
+def test_wkt_parts():
+    assert wkt_parts("Point (1 2)") == [([1.0], [2.0])]
+    assert wkt_parts("LineString Z (0 1 5, 2 3 5)") == [([0.0, 2.0], [1.0, 3.0])]
+    assert wkt_parts("MultiPoint ((1 2), (3 4))") == [([1.0], [2.0]), ([3.0], [4.0])]
+    assert wkt_parts("") == []
+
+def rows_with_geometry(kind):
+    # NumPy scalars among the coordinates, as the near runner's arrays hand them over
+    scalar = np.float64 if np is not None else float
+    return [[1, "a", 0.5, ([scalar(0.25), 1.0], [2.0, scalar(3.125)])],
+            [2, "b", -1.0, ([10.0, 11.5], [-2.0, 0.0])]]
+
+@pytest.mark.parametrize("kind", ["MultiPoint", "LineString"])
+def test_csv_round_trip(tmp_path, kind):
+    path = str(tmp_path / "out.csv")
+    writer = CsvWriter(path, FIELDS, kind, None)
+    writer.write(rows_with_geometry(kind))
+    writer.close()
+
+    srs, rows = read_features(path)
+    rows = list(rows)
+    assert srs is None
+    assert [(int(i[0]["fid"]), i[0]["name"], float(i[0]["value"])) for i in rows] == [(1, "a", 0.5), (2, "b", -1.0)]
+    expected = [row[-1] for row in rows_with_geometry(kind)]
+    if kind == "MultiPoint":
+        assert [i[1] for i in rows] == [[([x], [y]) for x, y in zip(*geometry)] for geometry in expected]
+    else:
+        assert [i[1] for i in rows] == [[geometry] for geometry in expected]
+
+@pytest.mark.parametrize("kind", ["MultiPoint", "LineString"])
+def test_gpkg_round_trip(tmp_path, kind):
+    path = str(tmp_path / "out.gpkg")
+    srs = ("Custom", 2263, "EPSG", 2263, "PROJCS[]", None)
+    writer = GpkgWriter(path, FIELDS, kind, srs)
+    writer.write(rows_with_geometry(kind))
+    writer.close()
+
+    read_srs, rows = read_features(path)
+    rows = list(rows)
+    assert tuple(read_srs[:2]) == ("Custom", 2263)
+    assert [(i[0]["fid"], i[0]["name"], i[0]["value"]) for i in rows] == [(1, "a", 0.5), (2, "b", -1.0)]
+    expected = [row[-1] for row in rows_with_geometry(kind)]
+    if kind == "MultiPoint":
+        assert [i[1] for i in rows] == [[([x], [y]) for x, y in zip(*geometry)] for geometry in expected]
+    else:
+        assert [i[1] for i in rows] == [[geometry] for geometry in expected]
+
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT min_x, min_y, max_x, max_y, srs_id FROM gpkg_contents").fetchone() == (0.25, -2.0, 11.5, 3.125, 2263)
+    assert connection.execute("SELECT geometry_type_name FROM gpkg_geometry_columns").fetchone() == (kind.upper(),)
+
+    # Headers written by other tools carry an envelope, sized by the flags
+    blob = connection.execute("SELECT geom FROM out WHERE fid = 2").fetchone()[0]
+    blob = blob[:3] + bytes([blob[3] | 0x02]) + blob[4:8] + struct.pack("<4d", 10.0, 11.5, -2.0, 0.0) + blob[8:]
+    connection.execute("UPDATE out SET geom = ? WHERE fid = 2", (blob,))
+    connection.commit()
+    connection.close()
+    assert list(read_features(path)[1])[1][1] == [i[1] for i in rows][1]
+
+@pytest.mark.skipif(batchrun.pyarrow is None, reason = "needs pyarrow")
+def test_parquet_round_trip(tmp_path):
+    path = str(tmp_path / "out.parquet")
+    writer = ParquetWriter(path, FIELDS, "LineString", None)
+    writer.write(rows_with_geometry("LineString"))
+    writer.close()
+
+    table = batchrun.pyarrow.parquet.read_table(path).to_pydict()
+    assert (table["fid"], table["name"], table["value"]) == ([1, 2], ["a", "b"], [0.5, -1.0])
+    assert [wkb_parts(i)[0] for i in table["geometry"]] == [[row[-1]] for row in rows_with_geometry("LineString")]
+
+def write_points(path, prefix, points):
+    with open(path, "w", newline = "") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["id", "x", "y"])
+        writer.writerows(("{0}{1}".format(prefix, i), x, y) for i, (x, y) in enumerate(points))
+
+@pytest.mark.skipif(np is None, reason = "needs NumPy")
+@pytest.mark.parametrize("output_format", ["csv", "gpkg"])
+def test_near_lines_round_trip(tmp_path, output_format):
+    near = [(0.0, 3.0), (4.0, 0.0), (10.5, 10.25)]
+    inputs = [(0.0, 0.0), (1.0, 1.0)]
+    write_points(str(tmp_path / "near.csv"), "n", near)
+    write_points(str(tmp_path / "in.csv"), "i", inputs)
+    main(["-o", str(tmp_path / "out"), "-f", output_format, "near", str(tmp_path / "near.csv"), str(tmp_path / "in.csv"),
+          "--input-field", "id", "--near-field", "id", "--lines", "--k-nearest", "2"])
+
+    rows = list(read_features(str(tmp_path / "out" / ("in." + output_format)))[1])
+    found = [(i[0]["id"], i[0]["id_"], float(i[0]["distance"]), i[1]) for i in rows]
+    expected = []
+    for input_idx, (x, y) in enumerate(inputs):
+        pairs = sorted((((x - near_x) ** 2 + (y - near_y) ** 2) ** 0.5, near_idx) for near_idx, (near_x, near_y) in enumerate(near))[:2]
+        expected += [("i{0}".format(input_idx), "n{0}".format(near_idx), distance, [([x, near[near_idx][0]], [y, near[near_idx][1]])]) for distance, near_idx in pairs]
+        continue
+    assert found == expected
+
+def test_input_paths_refuses_same_output_name(tmp_path):
+    for name in ("a.csv", "b.gpkg", "b.csv"):
+        (tmp_path / name).write_text("")
+        continue
+
+    with pytest.raises(SystemExit):
+        input_paths([str(tmp_path)])
+    assert input_paths([str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]) == [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checks of the geometry core against its reference implementations: the indexed and batch engines
+against plain scans, the NumPy routines against their pure Python fallbacks and brute force.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import random
+import time
+from math import cos, hypot, inf, sin, sqrt
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geomcore
+from geomcore import (alignment_chainage,
+                      build_alignment,
+                      bounded_nearest,
+                      closest_segment,
+                      cut_ranges,
+                      envelope_distances,
+                      load_alignment,
+                      measure_along_line,
+                      measure_along_line_indexed,
+                      nearest_points,
+                      project_events,
+                      project_points,
+                      save_alignment,
+                      station_points,
+                      station_points_scalar,
+                      np)
+
+needs_numpy = pytest.mark.skipif(np is None, reason = "needs NumPy")
+
+
+def random_walk(rng, count, step = 10.0, grid = False):
+    """
+    Bent line of count vertices. On a grid, vertices are whole numbers so events tie between segments.
+    """
+    xs = [0.0]
+    ys = [0.0]
+    heading = 0.0
+    for _ in range(count - 1):
+        heading += rng.uniform(-1.0, 1.0)
+        length = rng.uniform(0.2, 1.8) * step
+        x = xs[-1] + length * cos(heading)
+        y = ys[-1] + length * sin(heading)
+        xs.append(float(round(x)) if grid else float(x))
+        ys.append(float(round(y)) if grid else float(y))
+        continue
+    return xs, ys
+
+def random_events(rng, xs, ys, count, spread = 30.0, grid = False):
+    """
+    Events scattered around the bounding box of the line.
+    """
+    events = []
+    for _ in range(count):
+        x = rng.uniform(min(xs) - spread, max(xs) + spread)
+        y = rng.uniform(min(ys) - spread, max(ys) + spread)
+        events.append((float(round(x)), float(round(y))) if grid else (x, y))
+        continue
+    return events
+
+def network(rng, routes = 3, vertices = 40, grid = False):
+    """
+    build_alignment result of a few random walk routes laid over each other.
+    """
+    lines = []
+    for route in range(routes):
+        xs, ys = random_walk(rng, vertices, grid = grid)
+        lines.append(("R{0}".format(route), xs, ys))
+        continue
+    return build_alignment(lines)
+
+def polyline_length(xs, ys):
+    return sum(hypot(xs[i + 1] - xs[i], ys[i + 1] - ys[i]) for i in range(len(xs) - 1))
+
+
+def test_measure_indexed_matches_reference():
+    rng = random.Random(0)
+    xs, ys = random_walk(rng, 200)
+    chainage = alignment_chainage(xs, ys)
+    for _ in range(1000):
+        vertex_idx_before = rng.randrange(len(xs) - 1)
+        t = rng.random()
+        x = xs[vertex_idx_before] + t * (xs[vertex_idx_before + 1] - xs[vertex_idx_before])
+        y = ys[vertex_idx_before] + t * (ys[vertex_idx_before + 1] - ys[vertex_idx_before])
+        assert measure_along_line_indexed(xs, ys, chainage, vertex_idx_before, x, y) == pytest.approx(measure_along_line(xs, ys, vertex_idx_before, x, y), abs = 1e-9)
+        continue
+
+def test_measure_bent_alignment():
+    # The walk used to stop a vertex early and take the chord from there to the point, 10 + sqrt(125) here
+    xs = [0.0, 10.0, 10.0, 20.0]
+    ys = [0.0, 0.0, 10.0, 10.0]
+    chainage = alignment_chainage(xs, ys)
+    assert chainage == [0.0, 10.0, 20.0, 30.0]
+    assert measure_along_line(xs, ys, 2, 15.0, 10.0) == 25.0
+    assert measure_along_line_indexed(xs, ys, chainage, 2, 15.0, 10.0) == 25.0
+    assert measure_along_line_indexed(xs, ys, chainage, 0, 4.0, 0.0) == 4.0
+
+@pytest.mark.parametrize("grid", [False, True])
+def test_segment_index_matches_full_scan(grid):
+    rng = random.Random(1)
+    route_ids, chainages, segment_index = network(rng, grid = grid)
+    joins = set(segment_index.route_starts[1:])
+    segment_ids = [i for i in range(1, len(segment_index.xs)) if i not in joins]
+
+    for x, y in random_events(rng, segment_index.xs, segment_index.ys, 500, grid = grid):
+        expected = closest_segment(segment_index.xs, segment_index.ys, x, y, segment_ids)
+        assert segment_index.closest_segment(x, y) == expected
+
+        for epsilon in (1.0, 5.0, 20.0):
+            found = segment_index.closest_segment(x, y, epsilon)
+            if sqrt(expected[0]) > epsilon:
+                assert found is None
+            else:
+                assert found == expected
+            continue
+        continue
+
+@needs_numpy
+@pytest.mark.parametrize("grid", [False, True])
+@pytest.mark.parametrize("count, spread", [(2000, 30.0), (200, 30.0), (200, 500.0)])
+def test_project_points_matches_scalar_path(grid, count, spread, monkeypatch):
+    # Dense events fill tiles, sparse ones take the scalar search, far ones tiles of their own
+    rng = random.Random(2)
+    route_ids, chainages, segment_index = network(rng, grid = grid)
+    events = random_events(rng, segment_index.xs, segment_index.ys, count, spread, grid)
+    event_xs = [i[0] for i in events]
+    event_ys = [i[1] for i in events]
+
+    for epsilon in (-1, 5.0):
+        hit, distance_away, distance_line, line_x, line_y, side_of_line, vertex_after = project_points(segment_index, chainages, event_xs, event_ys, epsilon)
+        batch = [i[1:] if i[0] else None for i in zip(hit.tolist(), distance_away.tolist(), distance_line.tolist(), line_x.tolist(), line_y.tolist(), side_of_line.tolist(), vertex_after.tolist())]
+
+        with monkeypatch.context() as patch:
+            patch.setattr(geomcore, "np", None)
+            scalar = project_events(segment_index, chainages, event_xs, event_ys, epsilon)
+
+        assert len(batch) == len(scalar)
+        for batch_result, scalar_result in zip(batch, scalar):
+            if scalar_result is None:
+                assert batch_result is None
+                continue
+
+            assert batch_result is not None
+            assert batch_result[4:] == scalar_result[4:]
+            assert batch_result[:4] == pytest.approx(scalar_result[:4], abs = 1e-9)
+            continue
+        continue
+
+@needs_numpy
+def test_project_points_not_slower_on_sparse_events(monkeypatch):
+    # A long bent alignment with few events around it, most tiles too sparse to be worth the array set up
+    rng = np.random.default_rng(8)
+    steps = rng.normal(0.0, 10.0, (20000, 2))
+    route_ids, chainages, segment_index = build_alignment([("R0", np.cumsum(steps[:, 0]).tolist(), np.cumsum(steps[:, 1]).tolist())])
+    vertices = rng.integers(0, 20000, 2000)
+    event_xs = (np.asarray(segment_index.xs)[vertices] + rng.uniform(-25.0, 25.0, 2000)).tolist()
+    event_ys = (np.asarray(segment_index.ys)[vertices] + rng.uniform(-25.0, 25.0, 2000)).tolist()
+
+    for epsilon in (-1, 5.0):
+        batch = scalar = inf
+        for _ in range(3):
+            start = time.perf_counter()
+            project_events(segment_index, chainages, event_xs, event_ys, epsilon)
+            batch = min(batch, time.perf_counter() - start)
+            continue
+
+        with monkeypatch.context() as patch:
+            patch.setattr(geomcore, "np", None)
+            for _ in range(3):
+                start = time.perf_counter()
+                project_events(segment_index, chainages, event_xs, event_ys, epsilon)
+                scalar = min(scalar, time.perf_counter() - start)
+                continue
+
+        assert batch < 2 * scalar
+        continue
+
+@needs_numpy
+def test_nearest_points_matches_sorted_scan():
+    # Whole number coordinates on a small grid tie a lot of pairs at the k-th distance
+    rng = np.random.default_rng(7)
+    for trial in range(100):
+        input_xy = rng.integers(0, 6, (20, 2)).astype(float)
+        near_xy = rng.integers(0, 6, (int(rng.integers(1, 40)), 2)).astype(float)
+        k_nearest = int(rng.integers(0, 8))
+        max_distance = float(rng.choice([-1, 2]))
+        input_idx, near_idx, distance = nearest_points(input_xy, near_xy, k_nearest, max_distance)
+
+        # Full matrix in layer order, any limit sorted like the indexed path
+        expected = []
+        for row, (x, y) in enumerate(input_xy.tolist()):
+            pairs = [(float(np.hypot(x - near_x, y - near_y)), col) for col, (near_x, near_y) in enumerate(near_xy.tolist())]
+            if k_nearest > 0 or max_distance != -1:
+                pairs = sorted(pairs)[:k_nearest or None]
+            expected += [(row, col, dist) for dist, col in pairs if max_distance == -1 or dist <= max_distance]
+            continue
+        assert list(zip(input_idx.tolist(), near_idx.tolist(), distance.tolist())) == expected
+        continue
+
+@needs_numpy
+def test_bounded_nearest_matches_brute_force():
+    rng = np.random.default_rng(3)
+    for trial in range(300):
+        count = int(rng.integers(1, 150))
+        starts = rng.uniform(0, 100, (count, 2))
+        ends = starts + rng.normal(0, 5, (count, 2))
+        point = rng.uniform(0, 100, 2)
+        if trial % 3 == 0:
+            starts, ends, point = np.round(starts), np.round(ends), np.round(point)
+        boxes = np.column_stack((np.minimum(starts, ends), np.maximum(starts, ends)))
+
+        def exact(idx):
+            # Point to segment distance
+            direction = ends[idx] - starts[idx]
+            length = direction @ direction
+            t = 0.0 if length == 0 else min(1.0, max(0.0, (point - starts[idx]) @ direction / length))
+            return float(np.hypot(*(starts[idx] + t * direction - point)))
+
+        k_nearest = int(rng.integers(0, 6))
+        max_distance = float(rng.choice([-1, 10, 30]))
+        expected = [i for i in sorted((exact(i), i) for i in range(count)) if max_distance == -1 or i[0] <= max_distance]
+        if k_nearest > 0:
+            expected = expected[:k_nearest]
+
+        ids = rng.permutation(count)
+        found, evaluated = bounded_nearest(ids, envelope_distances((point[0], point[1], point[0], point[1]), boxes[ids]), exact, k_nearest, max_distance)
+        assert found == expected
+        assert evaluated <= count
+        continue
+
+@needs_numpy
+def test_station_points_matches_scalar():
+    rng = random.Random(4)
+    route_ids, chainages, segment_index = network(rng)
+    route_count = len(segment_index.route_starts)
+
+    routes = [rng.randrange(route_count) for _ in range(1000)]
+    measures = [rng.uniform(-20.0, max(chainages) + 20.0) for _ in routes]
+    offsets = [rng.uniform(-15.0, 15.0) for _ in routes]
+    # Stations exactly on vertices, where the segment before and the one after both apply
+    routes += [0] * 5
+    measures += list(chainages[1:6])
+    offsets += [3.0] * 5
+
+    batch = station_points(segment_index.xs, segment_index.ys, chainages, segment_index.route_starts, routes, measures, offsets)
+    scalar = station_points_scalar(segment_index.xs, segment_index.ys, chainages, segment_index.route_starts, routes, measures, offsets)
+    assert batch[0].tolist() == list(scalar[0])
+    for batch_values, scalar_values in zip(batch[1:], scalar[1:]):
+        assert batch_values.tolist() == pytest.approx(list(scalar_values), abs = 1e-9)
+        continue
+
+def test_cut_ranges_lengths():
+    rng = random.Random(5)
+    route_ids, chainages, segment_index = network(rng)
+    route_starts = segment_index.route_starts
+    ends = route_starts[1:] + [len(segment_index.xs)]
+
+    ranges = []
+    for _ in range(300):
+        route = rng.randrange(len(route_starts))
+        route_length = chainages[ends[route] - 1]
+        from_measure, to_measure = sorted((rng.uniform(0.0, route_length), rng.uniform(0.0, route_length)))
+        ranges.append((route, from_measure, to_measure))
+        continue
+    ranges.append((0, 0.0, chainages[ends[0] - 1]))
+
+    for (route, from_measure, to_measure), (line_xs, line_ys) in zip(ranges, cut_ranges(segment_index.xs, segment_index.ys, chainages, route_starts, ranges)):
+        assert polyline_length(line_xs, line_ys) == pytest.approx(to_measure - from_measure, abs = 1e-6)
+        continue
+
+@needs_numpy
+def test_alignment_cache_round_trip(tmp_path):
+    rng = random.Random(6)
+    route_ids, chainages, segment_index = network(rng)
+    path = str(tmp_path / "entry")
+    save_alignment(path, route_ids, chainages, segment_index)
+    loaded_ids, loaded_chainages, loaded_index = load_alignment(path)
+
+    assert loaded_ids == route_ids
+    assert list(loaded_chainages) == list(chainages)
+    assert list(loaded_index.route_starts) == list(segment_index.route_starts)
+    # The entry is used where it lies, nothing is copied out or rebuilt
+    assert isinstance(loaded_index.xs, np.ndarray) and isinstance(loaded_index.xs.base, np.memmap)
+    assert loaded_index.cells is None
+
+    events = random_events(rng, segment_index.xs, segment_index.ys, 500)
+    event_xs = [i[0] for i in events]
+    event_ys = [i[1] for i in events]
+    for x, y in events:
+        assert loaded_index.closest_segment(x, y) == segment_index.closest_segment(x, y)
+        assert loaded_index.closest_segment(x, y, 5.0) == segment_index.closest_segment(x, y, 5.0)
+        continue
+    assert project_events(loaded_index, loaded_chainages, event_xs, event_ys) == project_events(segment_index, chainages, event_xs, event_ys)